@@ -4,11 +4,13 @@ import asyncio
 import json
 import logging
 import os
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Dict, List
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from google.api_core import exceptions as google_exceptions
 from google.cloud import firestore
 from google.cloud import pubsub_v1
@@ -21,6 +23,14 @@ except ImportError as exc:  # pragma: no cover
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# ListRagFiles page size (the API maximum).
+RAG_FILES_PAGE_SIZE = 1000
+# Request only the RagFile name and source; the rest of each RagFile is never read.
+RAG_FILES_FIELD_MASK = (("x-goog-fieldmask", "rag_files.name,rag_files.gcs_source,next_page_token"),)
+# Backoff bounds for polling RAG import operations.
+OPERATION_POLL_INITIAL_SECONDS = 1.0
+OPERATION_POLL_MAX_SECONDS = 30.0
+
 
 @dataclass(frozen=True)
 class Settings:
@@ -36,15 +46,23 @@ class Settings:
 
 settings = Settings()
 
-firestore_client: firestore.Client | None = None
+
+RAG_CHUNKING_KWARGS: Dict[str, int] = {}
+if settings.rag_chunk_size_tokens > 0:
+    RAG_CHUNKING_KWARGS["chunk_size"] = settings.rag_chunk_size_tokens
+    if settings.rag_chunk_overlap_tokens > 0:
+        RAG_CHUNKING_KWARGS["chunk_overlap"] = settings.rag_chunk_overlap_tokens
+
+firestore_client: firestore.AsyncClient | None = None
 rag_client: aiplatform_v1beta1.VertexRagDataServiceClient | None = None
 publisher_client: pubsub_v1.PublisherClient | None = None
+resolved_topic: str | None = None
 
 
-def get_firestore_client() -> firestore.Client:
+def get_firestore_client() -> firestore.AsyncClient:
     global firestore_client
     if firestore_client is None:
-        firestore_client = firestore.Client(project=settings.project_id or None)
+        firestore_client = firestore.AsyncClient(project=settings.project_id or None)
     return firestore_client
 
 
@@ -66,8 +84,16 @@ def get_publisher_client() -> pubsub_v1.PublisherClient:
 
 
 async def await_operation(operation) -> None:
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, operation.result)
+    """Poll a long-running operation without pinning an executor thread for its lifetime."""
+    if not hasattr(operation, "done"):
+        await asyncio.to_thread(operation.result)
+        return
+    delay = OPERATION_POLL_INITIAL_SECONDS
+    # done() refreshes over the network, so each poll is a short hop onto a worker thread.
+    while not await asyncio.to_thread(operation.done):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, OPERATION_POLL_MAX_SECONDS)
+    operation.result()
 
 
 def _rag_file_payload(name: str, source_uri: str) -> Dict[str, Any]:
@@ -82,10 +108,48 @@ def _rag_file_payload(name: str, source_uri: str) -> Dict[str, Any]:
     return payload
 
 
+def get_resolved_topic() -> str:
+    """Return the fully qualified status topic, resolving it on first use."""
+    global resolved_topic
+    if resolved_topic is None:
+        topic = settings.pubsub_topic
+        if not topic.startswith("projects/"):
+            if not settings.project_id:
+                raise RuntimeError("INGEST_TOPIC must be a full topic path when GCP_PROJECT is not set.")
+            topic = pubsub_v1.PublisherClient.topic_path(settings.project_id, topic)
+        resolved_topic = topic
+    return resolved_topic
+
+
+def _match_rag_files(
+    client: aiplatform_v1beta1.VertexRagDataServiceClient,
+    gcs_uris: List[str],
+) -> Dict[str, str]:
+    """Map each ingested GCS URI to its RagFile resource name."""
+    rag_files: Dict[str, str] = {}
+    wanted = frozenset(gcs_uris)
+    list_request = aiplatform_v1beta1.ListRagFilesRequest(
+        parent=settings.rag_corpus_path,
+        page_size=RAG_FILES_PAGE_SIZE,
+    )
+    for rag_file in client.list_rag_files(request=list_request, metadata=RAG_FILES_FIELD_MASK):
+        gcs_source = getattr(rag_file, "gcs_source", None)
+        if not gcs_source:
+            continue
+        uris = getattr(gcs_source, "uris", [])
+        for uri in uris:
+            if uri in wanted:
+                rag_files[uri] = rag_file.name
+        # ListRagFiles has no filter; stop paging once every URI is accounted for.
+        if len(rag_files) == len(wanted):
+            break
+    return rag_files
+
+
 def _publish_status(tender_id: str, status: str) -> None:
     if not settings.pubsub_topic:
         return
-    topic = settings.pubsub_topic
+    topic = get_resolved_topic()
     publisher = get_publisher_client()
     message = json.dumps({"tenderId": tender_id, "status": status}).encode("utf-8")
     publisher.publish(topic, data=message)
@@ -96,37 +160,36 @@ async def ingest_tender(tender_id: str, gcs_uris: List[str]) -> Dict[str, Any]:
     firestore_db = get_firestore_client()
     doc_ref = firestore_db.collection(settings.firestore_collection).document(tender_id)
 
-    doc_ref.set(
-        {
-            "ragIngestion": {
-                "status": "running",
-                "startedAt": datetime.now(timezone.utc).isoformat(),
-                "completedAt": None,
-                "lastError": None,
-            }
-        },
-        merge=True,
-    )
-    _publish_status(tender_id, "running")
-
     import_config = {"gcs_source": {"uris": gcs_uris}}
-    if settings.rag_chunk_size_tokens > 0:
-        chunk_kwargs = {"chunk_size": settings.rag_chunk_size_tokens}
-        if settings.rag_chunk_overlap_tokens > 0:
-            chunk_kwargs["chunk_overlap"] = settings.rag_chunk_overlap_tokens
-        import_config["rag_file_chunking_config"] = aiplatform_v1beta1.RagFileChunkingConfig(**chunk_kwargs)  # type: ignore[attr-defined]
+    if RAG_CHUNKING_KWARGS:
+        import_config["rag_file_chunking_config"] = aiplatform_v1beta1.RagFileChunkingConfig(**RAG_CHUNKING_KWARGS)  # type: ignore[attr-defined]
     request = aiplatform_v1beta1.ImportRagFilesRequest(
         parent=settings.rag_corpus_path,
         import_rag_files_config=import_config,
     )
-    operation = client.import_rag_files(request=request)
+    # The status write and the import submission are independent; overlap their round trips.
+    _, operation = await asyncio.gather(
+        doc_ref.set(
+            {
+                "ragIngestion": {
+                    "status": "running",
+                    "startedAt": datetime.now(timezone.utc).isoformat(),
+                    "completedAt": None,
+                    "lastError": None,
+                }
+            },
+            merge=True,
+        ),
+        asyncio.to_thread(client.import_rag_files, request=request),
+    )
+    _publish_status(tender_id, "running")
     operation_name = getattr(getattr(operation, "operation", None), "name", None)
 
     try:
         await await_operation(operation)
     except google_exceptions.GoogleAPICallError as exc:
         error_message = str(exc)
-        doc_ref.set(
+        await doc_ref.set(
             {
                 "ragIngestion": {
                     "status": "failed",
@@ -139,19 +202,10 @@ async def ingest_tender(tender_id: str, gcs_uris: List[str]) -> Dict[str, Any]:
         _publish_status(tender_id, "failed")
         raise
 
-    rag_files: Dict[str, str] = {}
-    for rag_file in client.list_rag_files(parent=settings.rag_corpus_path):
-        gcs_source = getattr(rag_file, "gcs_source", None)
-        if not gcs_source:
-            continue
-        uris = getattr(gcs_source, "uris", [])
-        for uri in uris:
-            if uri in gcs_uris:
-                rag_files[uri] = rag_file.name
-
+    rag_files = await asyncio.to_thread(_match_rag_files, client, gcs_uris)
     rag_file_payloads = [_rag_file_payload(name, uri) for uri, name in rag_files.items()]
 
-    doc_ref.set(
+    await doc_ref.set(
         {
             "ragIngestion": {
                 "status": "done",
@@ -167,7 +221,17 @@ async def ingest_tender(tender_id: str, gcs_uris: List[str]) -> Dict[str, Any]:
     return {"ragFiles": rag_file_payloads, "operationName": operation_name}
 
 
-app = FastAPI(title="RAG Ingestion Worker", version="0.1.0")
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Fail at boot rather than on the first ingest when the topic is misconfigured.
+    if settings.pubsub_topic:
+        get_resolved_topic()
+    yield
+
+
+app = FastAPI(
+    title="RAG Ingestion Worker", version="0.1.0", default_response_class=ORJSONResponse, lifespan=_lifespan
+)
 
 
 @app.post("/ingest")
@@ -177,7 +241,7 @@ async def ingest(payload: Dict[str, Any]) -> Dict[str, Any]:
     if not tender_id or not gcs_uris:
         raise HTTPException(status_code=400, detail="tenderId and gcsUris are required")
     try:
-        return await ingest_tender(str(tender_id), list(gcs_uris))
+        return await ingest_tender(str(tender_id), list(dict.fromkeys(gcs_uris)))
     except google_exceptions.GoogleAPICallError as exc:
         raise HTTPException(status_code=502, detail=f"Ingestion failed: {exc}") from exc
 
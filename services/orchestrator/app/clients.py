@@ -1,10 +1,12 @@
 from __future__ import annotations
 
-from typing import Any, Optional, Tuple
+from functools import partial
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
 
 from google.auth import exceptions as auth_exceptions
 from google.cloud import firestore, storage
-from google.cloud.firestore import Client as FirestoreClient
+from google.cloud.firestore import AsyncClient as FirestoreClient
 
 import vertexai
 
@@ -17,22 +19,39 @@ from .config import settings
 
 _firestore_client: FirestoreClient | None = None
 _storage_client: storage.Client | None = None
+_bucket_cache: Dict[str, storage.Bucket] = {}
 _rag_data_client: Any | None = None
 _rag_service_client: Any | None = None
 _vertexai_init_context: Optional[Tuple[str, str]] = None
+# Ping connections, including idle ones, so a channel that sat quiet between playbook bursts is
+# known-good (or replaced) before the next call. The library default of two pings without data
+# (grpc.http2.max_pings_without_data) is kept, so an idle channel sends at most two pings a minute
+# apart and stays clear of Google front ends' too_many_pings GOAWAY.
+_GRPC_KEEPALIVE_OPTIONS = (
+    ("grpc.keepalive_time_ms", 60_000),
+    ("grpc.keepalive_timeout_ms", 10_000),
+    ("grpc.keepalive_permit_without_calls", 1),
+)
+# One lock per client so concurrent first requests construct each client once.
+_firestore_lock = Lock()
+_storage_lock = Lock()
+_rag_data_lock = Lock()
+_rag_service_lock = Lock()
 
 
 def get_firestore_client() -> FirestoreClient:
     global _firestore_client
     if _firestore_client is not None:
         return _firestore_client
-    try:
-        _firestore_client = firestore.Client(project=settings.project_id or None)
-    except auth_exceptions.DefaultCredentialsError as exc:  # pragma: no cover - env misconfig
-        raise RuntimeError(
-            "Firestore credentials not configured. Set GOOGLE_APPLICATION_CREDENTIALS or "
-            "FIRESTORE_EMULATOR_HOST before starting the orchestrator service."
-        ) from exc
+    with _firestore_lock:
+        if _firestore_client is None:
+            try:
+                _firestore_client = firestore.AsyncClient(project=settings.project_id or None)
+            except auth_exceptions.DefaultCredentialsError as exc:  # pragma: no cover - env misconfig
+                raise RuntimeError(
+                    "Firestore credentials not configured. Set GOOGLE_APPLICATION_CREDENTIALS or "
+                    "FIRESTORE_EMULATOR_HOST before starting the orchestrator service."
+                ) from exc
     return _firestore_client
 
 
@@ -40,16 +59,37 @@ def get_storage_client() -> storage.Client:
     global _storage_client
     if _storage_client is not None:
         return _storage_client
-    try:
-        _storage_client = storage.Client(project=settings.project_id or None)
-    except auth_exceptions.DefaultCredentialsError as exc:  # pragma: no cover - env misconfig
-        raise RuntimeError(
-            "Google Cloud Storage credentials not configured. Set GOOGLE_APPLICATION_CREDENTIALS "
-            "or STORAGE_EMULATOR_HOST before starting the orchestrator service."
-        ) from exc
+    with _storage_lock:
+        if _storage_client is None:
+            try:
+                _storage_client = storage.Client(project=settings.project_id or None)
+            except auth_exceptions.DefaultCredentialsError as exc:  # pragma: no cover - env misconfig
+                raise RuntimeError(
+                    "Google Cloud Storage credentials not configured. Set GOOGLE_APPLICATION_CREDENTIALS "
+                    "or STORAGE_EMULATOR_HOST before starting the orchestrator service."
+                ) from exc
     return _storage_client
 
 
+def get_bucket(name: str) -> storage.Bucket:
+    bucket = _bucket_cache.get(name)
+    if bucket is None:
+        bucket = get_storage_client().bucket(name)
+        _bucket_cache[name] = bucket
+    return bucket
+
+
+def _keepalive_grpc_transport(client_cls):
+    """A transport factory for client_cls whose gRPC channel carries the keepalive options."""
+    transport_cls = client_cls.get_transport_class("grpc")
+
+    def _create_channel(host, **kwargs):
+        kwargs["options"] = [*kwargs.get("options", ()), *_GRPC_KEEPALIVE_OPTIONS]
+        return transport_cls.create_channel(host, **kwargs)
+
+    return partial(transport_cls, channel=_create_channel)
+
+
 def get_rag_data_client():
     global _rag_data_client
     if aiplatform_v1beta1 is None:  # pragma: no cover - optional dependency
@@ -60,11 +100,16 @@ def get_rag_data_client():
         raise RuntimeError("VERTEX_RAG_CORPUS_PATH environment variable is not configured.")
     if _rag_data_client is not None:
         return _rag_data_client
-    endpoint = None
-    if settings.vertex_rag_location:
-        endpoint = f"{settings.vertex_rag_location}-aiplatform.googleapis.com"
-    client_options = {"api_endpoint": endpoint} if endpoint else None
-    _rag_data_client = aiplatform_v1beta1.VertexRagDataServiceClient(client_options=client_options)
+    with _rag_data_lock:
+        if _rag_data_client is None:
+            endpoint = None
+            if settings.vertex_rag_location:
+                endpoint = f"{settings.vertex_rag_location}-aiplatform.googleapis.com"
+            client_options = {"api_endpoint": endpoint} if endpoint else None
+            _rag_data_client = aiplatform_v1beta1.VertexRagDataServiceClient(
+                client_options=client_options,
+                transport=_keepalive_grpc_transport(aiplatform_v1beta1.VertexRagDataServiceClient),
+            )
     return _rag_data_client
 
 
@@ -76,11 +121,16 @@ def get_rag_service_client():
         )
     if _rag_service_client is not None:
         return _rag_service_client
-    endpoint = None
-    if settings.vertex_rag_location:
-        endpoint = f"{settings.vertex_rag_location}-aiplatform.googleapis.com"
-    client_options = {"api_endpoint": endpoint} if endpoint else None
-    _rag_service_client = aiplatform_v1beta1.VertexRagServiceClient(client_options=client_options)
+    with _rag_service_lock:
+        if _rag_service_client is None:
+            endpoint = None
+            if settings.vertex_rag_location:
+                endpoint = f"{settings.vertex_rag_location}-aiplatform.googleapis.com"
+            client_options = {"api_endpoint": endpoint} if endpoint else None
+            _rag_service_client = aiplatform_v1beta1.VertexRagServiceClient(
+                client_options=client_options,
+                transport=_keepalive_grpc_transport(aiplatform_v1beta1.VertexRagServiceClient),
+            )
     return _rag_service_client
 
 
@@ -3,7 +3,9 @@ from __future__ import annotations
 import json
 import logging
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping
 
 logger = logging.getLogger(__name__)
 
@@ -20,13 +22,24 @@ def _load_service_map() -> dict[str, str]:
     return {key: value for key, value in base_map.items() if value}
 
 
+def _int_env(key: str, default: int) -> int:
+    value = os.getenv(key)
+    return int(value) if value else default
+
+
+def _float_env(key: str, default: float) -> float:
+    value = os.getenv(key)
+    return float(value) if value else default
+
+
 @dataclass(frozen=True)
 class Settings:
     project_id: str = os.getenv("GCP_PROJECT") or os.getenv("GOOGLE_CLOUD_PROJECT", "")
     pipeline_collection: str = os.getenv("PIPELINE_COLLECTION", "pipelineRuns")
     tenders_collection: str = os.getenv("TENDERS_COLLECTION", "tenders")
     parsed_collection: str = os.getenv("PARSED_COLLECTION", "parsedDocuments")
-    service_map: dict[str, str] = None  # type: ignore[assignment]
+    processed_events_collection: str = os.getenv("PROCESSED_EVENTS_COLLECTION", "processedEvents")
+    service_map: Mapping[str, str] = field(default_factory=lambda: MappingProxyType({}))
     vertex_rag_corpus_path: str = os.getenv("VERTEX_RAG_CORPUS_PATH", "")
     vertex_rag_location: str = os.getenv("VERTEX_RAG_CORPUS_LOCATION", "")
     vertex_rag_data_store_id: str = os.getenv("VERTEX_RAG_DATA_STORE_ID", "")
@@ -34,15 +47,22 @@ class Settings:
     vertex_rag_serving_config_path: str = os.getenv("VERTEX_RAG_SERVING_CONFIG_PATH", "")
     vertex_rag_default_branch: str = os.getenv("VERTEX_RAG_DEFAULT_BRANCH", "")
     vertex_rag_generative_model: str = os.getenv("VERTEX_RAG_GEMINI_MODEL", "gemini-2.5-flash")
-    vertex_rag_default_top_k: int = int(os.getenv("VERTEX_RAG_SIMILARITY_TOP_K", "10"))
+    vertex_rag_default_top_k: int = _int_env("VERTEX_RAG_SIMILARITY_TOP_K", 10)
     raw_bucket: str = os.getenv("RAW_TENDER_BUCKET", "rawtenderdata")
     parsed_bucket: str = os.getenv("PARSED_TENDER_BUCKET", "parsedtenderdata")
     playbook_config_path: str = os.getenv("PLAYBOOK_CONFIG_PATH", "")
-    vertex_rag_chunk_size_tokens: int = int(os.getenv("VERTEX_RAG_CHUNK_SIZE_TOKENS", "0"))
-    vertex_rag_chunk_overlap_tokens: int = int(os.getenv("VERTEX_RAG_CHUNK_OVERLAP_TOKENS", "0"))
-    vertex_rag_cache_ttl_seconds: int = int(os.getenv("VERTEX_RAG_CACHE_TTL_SECONDS", "300"))
-    vertex_rag_cache_max_entries: int = int(os.getenv("VERTEX_RAG_CACHE_MAX_ENTRIES", "64"))
-    vertex_rag_playbook_pacing_seconds: float = float(os.getenv("VERTEX_RAG_PLAYBOOK_PACING_SECONDS", "0"))
+    vertex_rag_chunk_size_tokens: int = _int_env("VERTEX_RAG_CHUNK_SIZE_TOKENS", 0)
+    vertex_rag_chunk_overlap_tokens: int = _int_env("VERTEX_RAG_CHUNK_OVERLAP_TOKENS", 0)
+    vertex_rag_cache_ttl_seconds: int = _int_env("VERTEX_RAG_CACHE_TTL_SECONDS", 300)
+    vertex_rag_cache_max_entries: int = _int_env("VERTEX_RAG_CACHE_MAX_ENTRIES", 64)
+    vertex_rag_semantic_cache_threshold: float = _float_env("VERTEX_RAG_SEMANTIC_CACHE_THRESHOLD", 0.0)
+    vertex_rag_embedding_model: str = os.getenv("VERTEX_RAG_EMBEDDING_MODEL", "text-embedding-004")
+    vertex_rag_files_map_ttl_seconds: int = _int_env("VERTEX_RAG_FILES_MAP_TTL_SECONDS", 60)
+    vertex_rag_delete_concurrency: int = _int_env("VERTEX_RAG_DELETE_CONCURRENCY", 6)
+    vertex_rag_playbook_pacing_seconds: float = _float_env("VERTEX_RAG_PLAYBOOK_PACING_SECONDS", 0.0)
+    vertex_rag_playbook_concurrency: int = _int_env("VERTEX_RAG_PLAYBOOK_CONCURRENCY", 8)
+    vertex_rag_context_cache_ttl_seconds: int = _int_env("VERTEX_RAG_CONTEXT_CACHE_TTL_SECONDS", 900)
+    blocking_io_workers: int = _int_env("BLOCKING_IO_WORKERS", 64)
 
 
-settings = Settings(service_map=_load_service_map())
+settings = Settings(service_map=MappingProxyType(_load_service_map()))
@@ -3,9 +3,17 @@ from __future__ import annotations
 import json
 import logging
 import os
+import posixpath
 import re
-from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import string
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+from itertools import islice
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
 
+from vertexai.preview.caching import CachedContent
 from vertexai.preview.generative_models import GenerativeModel, GenerationConfig, Part
 from google.auth import default as google_auth_default
 
@@ -14,26 +22,72 @@ from .config import settings
 
 if TYPE_CHECKING:  # pragma: no cover - typing support
     from .models import RagAnswer
+    from .rag import RetrievedContext
 
 logger = logging.getLogger(__name__)
 
+_FENCE_TAG_CHARS = string.ascii_letters + string.digits + "_-"
+_PAIR_RE = re.compile(r'"(label|value)"\s*:\s*"([^"\n]+)')
+_RESOURCE_PATH_RE = re.compile(r"projects/([^/]+)/locations/([^/]+)")
+_MIME_BY_EXT: Dict[str, str] = {
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+_DEFAULT_MIME = "application/octet-stream"
+# Words that make up an identifier label without carrying an actual identifier.
+_ID_STOPWORDS = frozenset({"rfp", "no.", "no", "number", "identifier", "id", "tender", "reference"})
+
+# (project, location, model, sorted URIs, mode)
+_ContextCacheKey = Tuple[str, str, str, Tuple[str, ...], str]
+# key -> (CachedContent or None when caching was refused, expiry on the monotonic clock)
+_context_cache: Dict[_ContextCacheKey, Tuple[Optional[CachedContent], float]] = {}
+_context_cache_lock = threading.Lock()
+_context_cache_pending: Dict[_ContextCacheKey, "_PendingContextCache"] = {}
+_auth_default_project: Optional[str] = None
+_auth_default_resolved = False
+_auth_lock = threading.Lock()
+# Stop using a cache entry slightly before the server expires it.
+_CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS = 30
+# CachedContent.create has no deadline; questions waiting on another's create send documents inline after this.
+_CONTEXT_CACHE_WAIT_SECONDS = 60.0
+
+
+class _PendingContextCache:
+    __slots__ = ("done", "result")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[CachedContent] = None
+
+
+@lru_cache(maxsize=8)
+def _get_model(
+    project_id: str,
+    location: str,
+    model_id: str,
+    cached_content: Optional[CachedContent] = None,
+) -> GenerativeModel:
+    """Return a shared model handle so its prediction client and connections are reused across calls."""
+    ensure_vertexai_initialized(project_id, location)
+    if cached_content is not None:
+        return GenerativeModel.from_cached_content(cached_content=cached_content)
+    return GenerativeModel(model_id)
+
 
 def run_generative_agent(
     project_id: str,
     location: str,
     question: str,
-    contexts: List[object],
+    contexts: Sequence["RetrievedContext"],
 ) -> Tuple[str, Optional[str]]:
     ensure_vertexai_initialized(project_id, location)
     model_id = settings.vertex_rag_generative_model or "gemini-2.5-flash"
-    model = GenerativeModel(model_id)
+    model = _get_model(project_id, location, model_id)
     if contexts:
         context_sections = []
         for idx, ctx in enumerate(contexts, start=1):
-            ctx_text = getattr(ctx, "text", "") or ""
-            source = getattr(ctx, "source_uri", "") or ""
-            if ctx_text:
-                context_sections.append(f"[Source {idx}] URI: {source}\n{ctx_text}")
+            if ctx.text:
+                context_sections.append(f"[Source {idx}] URI: {ctx.source_uri}\n{ctx.text}")
         prompt_context = "\n\n".join(context_sections)
     else:
         prompt_context = "(no context)"
@@ -53,16 +107,14 @@ def run_generative_agent(
         answer_text = ""
     if not answer_text or answer_text.upper() == "NOT_FOUND":
         return "", None
+    # Contexts carry their text lowered at retrieval time, so the match is lower() on both sides.
     answer_lower = answer_text.lower()
-    matched_source: Optional[str] = None
-    for ctx in contexts:
-        ctx_text = (getattr(ctx, "text", "") or "").lower()
-        if answer_lower in ctx_text:
-            matched_source = getattr(ctx, "source_uri", "") or None
-            if matched_source:
-                break
+    matched_source: Optional[str] = next(
+        (ctx.source_uri for ctx in contexts if ctx.source_uri and answer_lower in ctx.text_lower),
+        None,
+    )
     if not matched_source:
-        matched_source = getattr(contexts[0], "source_uri", None) if contexts else None
+        matched_source = contexts[0].source_uri if contexts else None
     return answer_text, matched_source
 
 
@@ -71,17 +123,19 @@ def generate_document_answer(
     gcs_uris: List[str],
     *,
     mode: str = "structured",
+    reuse_context: bool = False,
 ) -> Tuple[List[Dict[str, str]], str]:
+    """Answer the question directly from the documents.
+
+    reuse_context stores the documents in a Gemini context cache shared by later questions on the
+    same bundle; it only pays off when several questions follow, so one-off callers leave it off.
+    """
     if not gcs_uris:
         return [], ""
     project_id = settings.project_id or os.getenv("GOOGLE_CLOUD_PROJECT") or os.getenv("GCP_PROJECT")
     if not project_id:
-        try:
-            credentials, detected_project = google_auth_default()
-            project_id = detected_project
-        except Exception:  # pragma: no cover - metadata failures
-            project_id = None
-    location = settings.vertex_rag_location or _extract_location_from_path(settings.vertex_rag_corpus_path)
+        project_id = _default_project()
+    location = settings.vertex_rag_location or parse_resource_path(settings.vertex_rag_corpus_path)[1]
     if not project_id or not location:
         logger.warning(
             "Skipping direct document answer generation due to missing project (%s) or location (%s).",
@@ -92,27 +146,24 @@ def generate_document_answer(
 
     ensure_vertexai_initialized(project_id, location)
     model_id = settings.vertex_rag_generative_model or "gemini-2.5-flash"
-    model = GenerativeModel(model_id)
 
     parts: List[Part] = [Part.from_uri(uri, mime_type=_guess_mime_type(uri)) for uri in gcs_uris]
-    if mode == "structured":
-        instruction = (
-            "You are assisting with tender reviews. Use the supplied tender documents to answer the question by quoting "
-            "the exact wording from the text. Return the answer as a JSON array of objects, each with fields 'label' and "
-            "'value', preserving numbering, punctuation, dates, and times exactly as written. Use concise labels drawn from "
-            "the document (for example, table headers). Ignore lines that contain only underscores or placeholder tokens such as NA, N.A., or Not Available. "
-            "If the documents do not contain the requested information, respond with NOT_FOUND. "
-            "Example output: [{\"label\": \"RFP Number\", \"value\": \"RFP No. 001/MPSAPS/2025\"}]."
-        )
+    instruction = _document_instruction(mode)
+    cached_content = (
+        _get_cached_document_context(project_id, location, model_id, gcs_uris, mode, parts, instruction)
+        if reuse_context
+        else None
+    )
+    if cached_content is not None:
+        # Documents and instruction are already prefilled server-side; send only the question.
+        model = _get_model(project_id, location, model_id, cached_content)
+        contents: List[Part] = [Part.from_text(f"Question:\n{question}")]
     else:
-        instruction = (
-            "You are assisting with tender reviews. Answer the question using the supplied tender documents. "
-            "Quote or summarise the relevant information exactly as written, including numbering or bullet labels when helpful. "
-            "Respond with plain text (one or two sentences). If the documents do not contain the requested information, respond with NOT_FOUND."
-        )
+        model = _get_model(project_id, location, model_id)
+        contents = parts + [Part.from_text(f"{instruction}\n\nQuestion:\n{question}")]
     try:
         response = model.generate_content(
-            parts + [Part.from_text(f"{instruction}\n\nQuestion:\n{question}")],
+            contents,
             generation_config=GenerationConfig(temperature=0.0, max_output_tokens=1024),
         )
         answer_text = (getattr(response, "text", "") or "").strip()
@@ -148,6 +199,89 @@ def generate_document_answer(
     return [], clean_text
 
 
+def _default_project() -> Optional[str]:
+    """Resolve the ADC project once; google.auth.default() may hit the metadata server."""
+    global _auth_default_project, _auth_default_resolved
+    if not _auth_default_resolved:
+        with _auth_lock:
+            if not _auth_default_resolved:
+                try:
+                    _, _auth_default_project = google_auth_default()
+                except Exception:  # pragma: no cover - metadata failures
+                    _auth_default_project = None
+                _auth_default_resolved = True
+    return _auth_default_project
+
+
+def _document_instruction(mode: str) -> str:
+    if mode == "structured":
+        return (
+            "You are assisting with tender reviews. Use the supplied tender documents to answer the question by quoting "
+            "the exact wording from the text. Return the answer as a JSON array of objects, each with fields 'label' and "
+            "'value', preserving numbering, punctuation, dates, and times exactly as written. Use concise labels drawn from "
+            "the document (for example, table headers). Ignore lines that contain only underscores or placeholder tokens such as NA, N.A., or Not Available. "
+            "If the documents do not contain the requested information, respond with NOT_FOUND. "
+            "Example output: [{\"label\": \"RFP Number\", \"value\": \"RFP No. 001/MPSAPS/2025\"}]."
+        )
+    return (
+        "You are assisting with tender reviews. Answer the question using the supplied tender documents. "
+        "Quote or summarise the relevant information exactly as written, including numbering or bullet labels when helpful. "
+        "Respond with plain text (one or two sentences). If the documents do not contain the requested information, respond with NOT_FOUND."
+    )
+
+
+def _get_cached_document_context(
+    project_id: str,
+    location: str,
+    model_id: str,
+    gcs_uris: List[str],
+    mode: str,
+    parts: List[Part],
+    instruction: str,
+) -> Optional[CachedContent]:
+    """Return a Gemini context cache holding the documents and instruction, creating it on first use."""
+    ttl_seconds = settings.vertex_rag_context_cache_ttl_seconds
+    if ttl_seconds <= 0:
+        return None
+    key = (project_id, location, model_id, tuple(sorted(gcs_uris)), mode)
+    with _context_cache_lock:
+        now = time.monotonic()
+        entry = _context_cache.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        for stale_key in [k for k, (_, expires_at) in _context_cache.items() if expires_at <= now]:
+            del _context_cache[stale_key]
+        pending = _context_cache_pending.get(key)
+        leader = pending is None
+        if pending is None:
+            pending = _PendingContextCache()
+            _context_cache_pending[key] = pending
+    if not leader:
+        # Another question on this bundle is creating the cache; share its outcome.
+        if not pending.done.wait(_CONTEXT_CACHE_WAIT_SECONDS):
+            logger.info("Gemini context cache for %s still being created; sending documents inline.", key[3])
+            return None
+        return pending.result
+    cached_content: Optional[CachedContent] = None
+    try:
+        cached_content = CachedContent.create(
+            model_name=model_id,
+            system_instruction=instruction,
+            contents=parts,
+            ttl=timedelta(seconds=ttl_seconds),
+        )
+    except Exception as exc:  # pragma: no cover - e.g. bundle below the minimum cacheable size
+        logger.info("Gemini context cache unavailable for %s; sending documents inline: %s", key[3], exc)
+    finally:
+        expires_at = time.monotonic() + max(ttl_seconds - _CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS, 1)
+        with _context_cache_lock:
+            _context_cache[key] = (cached_content, expires_at)
+            _context_cache_pending.pop(key, None)
+        pending.result = cached_content
+        pending.done.set()
+    return cached_content
+
+
 def has_substantive_answer(answers: List["RagAnswer"]) -> bool:
     for answer in answers:
         raw_text = (answer.text or "").strip()
@@ -158,14 +292,15 @@ def has_substantive_answer(answers: List["RagAnswer"]) -> bool:
             continue
         if "__" in raw_text:
             continue
-        digit_count = sum(char.isdigit() for char in raw_text)
+        # Only 0, 1 or "2 or more" matters, so stop scanning at the second digit.
+        digit_count = sum(1 for _ in islice(filter(str.isdigit, raw_text), 2))
         if digit_count == 1 and "0" in raw_text and len(raw_text) < 40:
             continue
         if digit_count >= 2:
             return True
         if digit_count == 0:
-            tokens = [token for token in lowered.replace("\n", " ").split() if token]
-            if tokens and not all(token in {"rfp", "no.", "no", "number", "identifier", "id", "tender", "reference"} for token in tokens):
+            # Substantive as soon as one word is more than identifier boilerplate.
+            if any(token not in _ID_STOPWORDS for token in lowered.split()):
                 return True
             continue
         return True
@@ -173,30 +308,23 @@ def has_substantive_answer(answers: List["RagAnswer"]) -> bool:
 
 
 def _guess_mime_type(uri: str) -> str:
-    if uri.endswith(".pdf"):
-        return "application/pdf"
-    if uri.endswith(".docx"):
-        return "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    return "application/octet-stream"
+    return _MIME_BY_EXT.get(posixpath.splitext(uri)[1].lower(), _DEFAULT_MIME)
 
 
-def _extract_location_from_path(resource_path: str) -> str | None:
-    if not resource_path:
-        return None
-    marker = "/locations/"
-    start = resource_path.find(marker)
-    if start == -1:
-        return None
-    start += len(marker)
-    end = resource_path.find("/", start)
-    location = resource_path[start:] if end == -1 else resource_path[start:end]
-    return location or None
+@lru_cache(maxsize=8)
+def parse_resource_path(resource_path: str) -> Tuple[Optional[str], Optional[str]]:
+    """(project, location) from a `projects/{p}/locations/{l}/...` resource path."""
+    match = _RESOURCE_PATH_RE.search(resource_path or "")
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
 
 
 def _strip_code_fence(text: str) -> str:
     stripped = text.strip()
     if stripped.startswith("```"):
-        stripped = re.sub(r"^```[a-zA-Z0-9_-]*\s*", "", stripped)
+        # Drop the fence and any language tag ("```json"), then the whitespace after it.
+        stripped = stripped[3:].lstrip(_FENCE_TAG_CHARS).lstrip()
     if stripped.endswith("```"):
         stripped = stripped[:-3].rstrip()
     return stripped
@@ -206,25 +334,19 @@ def _recover_pairs_from_fallback(text: str) -> List[Dict[str, str]]:
     pairs: List[Dict[str, str]] = []
     label: Optional[str] = None
     value: Optional[str] = None
-    for line in text.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        label_match = re.search(r'"label"\s*:\s*"([^"\n]+)', line)
-        if label_match:
+    for match in _PAIR_RE.finditer(text):
+        kind, captured = match.group(1), match.group(2).strip()
+        if kind == "label":
             if label and value:
                 pairs.append({"label": label, "value": value})
-            label = label_match.group(1).strip()
+            label = captured
             value = None
             continue
-        value_match = re.search(r'"value"\s*:\s*"([^"\n]+)', line)
-        if value_match:
-            value = value_match.group(1).strip()
-            if label:
-                pairs.append({"label": label, "value": value})
-                label = None
-                value = None
-            continue
+        value = captured
+        if label:
+            pairs.append({"label": label, "value": value})
+            label = None
+            value = None
     if label and value:
         pairs.append({"label": label, "value": value})
     return pairs
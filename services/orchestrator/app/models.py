@@ -10,6 +10,8 @@ class PlaybookQuestion(BaseModel):
     display: str = Field(alias="display")
     prompt: str
     page_size: int | None = Field(default=None, alias="pageSize")
+    # Run the Gemini document pass even when RAG already answered, and let its structured entries win.
+    prefer_structured: bool = Field(default=False, alias="preferStructured")
 
 
 class RagPlaybookRequest(BaseModel):
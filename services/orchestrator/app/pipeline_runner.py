@@ -1,28 +1,63 @@
 from __future__ import annotations
 
 import asyncio
+import logging
 from datetime import datetime, timezone
 from typing import Any, Dict, List
 
 import httpx
 from google.cloud import firestore
-from google.cloud.firestore import Client as FirestoreClient
+from google.cloud.firestore import AsyncClient as FirestoreClient
 
 from pipeline import DEFAULT_PIPELINE, Task
 
 from .config import settings
 
+logger = logging.getLogger(__name__)
 
 async def execute_pipeline(
     firestore_client: FirestoreClient,
-    run_ref: firestore.DocumentReference,
+    run_ref: firestore.AsyncDocumentReference,
     run_document: Dict[str, Any],
+    http_client: httpx.AsyncClient | None = None,
+) -> None:
+    """Run the pipeline to a terminal status.
+
+    This runs after the Pub/Sub push has been acknowledged and its message recorded as processed,
+    so a redelivery will never restart it; any unexpected error marks the run failed instead of
+    leaving it queued or running. Without an http_client, one is opened and closed for this run.
+    """
+    try:
+        if http_client is not None:
+            await _execute_pipeline(firestore_client, run_ref, run_document, http_client)
+        else:
+            async with create_http_client() as client:
+                await _execute_pipeline(firestore_client, run_ref, run_document, client)
+    except Exception as exc:
+        logger.exception("Pipeline run %s failed unexpectedly.", run_ref.id)
+        try:
+            await run_ref.update(
+                {
+                    "status": "failed",
+                    "error": str(exc),
+                    "updatedAt": datetime.now(timezone.utc).isoformat(),
+                }
+            )
+        except Exception:
+            logger.exception("Could not mark pipeline run %s failed.", run_ref.id)
+
+
+async def _execute_pipeline(
+    firestore_client: FirestoreClient,
+    run_ref: firestore.AsyncDocumentReference,
+    run_document: Dict[str, Any],
+    http_client: httpx.AsyncClient,
 ) -> None:
     try:
         tender_id = run_ref.parent.parent.id
-        normalized_document = _load_normalized_document(firestore_client, tender_id)
+        normalized_document = await _load_normalized_document(firestore_client, tender_id)
     except KeyError as exc:
-        run_ref.update(
+        await run_ref.update(
             {
                 "status": "failed",
                 "error": str(exc),
@@ -39,53 +74,61 @@ async def execute_pipeline(
         pending = [task for task in stage_tasks if tasks_state[task.task_id]["status"] in {"pending", "retry"}]
         if not pending:
             current_stage += 1
-            run_ref.update({"currentStage": current_stage, "updatedAt": datetime.now(timezone.utc).isoformat()})
+            await run_ref.update({"currentStage": current_stage, "updatedAt": datetime.now(timezone.utc).isoformat()})
             continue
         if stage_tasks[0].stage == "parallel":
-            results = await _run_tasks_concurrently(run_ref, pending, normalized_document)
+            results = await _run_tasks_concurrently(http_client, run_ref, pending, tasks_state, normalized_document)
         else:
-            results = [await _run_task(run_ref, task, normalized_document) for task in pending]
+            results = [
+                await _run_task(http_client, run_ref, task, tasks_state[task.task_id], normalized_document)
+                for task in pending
+            ]
         if any(result == "failed" for result in results):
-            run_ref.update({"status": "failed", "updatedAt": datetime.now(timezone.utc).isoformat()})
+            await run_ref.update({"status": "failed", "updatedAt": datetime.now(timezone.utc).isoformat()})
             return
-    run_ref.update({"status": "succeeded", "updatedAt": datetime.now(timezone.utc).isoformat()})
+    await run_ref.update({"status": "succeeded", "updatedAt": datetime.now(timezone.utc).isoformat()})
 
 
 async def _run_tasks_concurrently(
-    run_ref: firestore.DocumentReference,
+    http_client: httpx.AsyncClient,
+    run_ref: firestore.AsyncDocumentReference,
     tasks: List[Task],
+    tasks_state: Dict[str, Dict[str, Any]],
     normalized_document: Dict[str, Any],
 ) -> List[str]:
-    async with httpx.AsyncClient(timeout=30) as client:
-        coroutines = [_run_task(run_ref, task, normalized_document, client) for task in tasks]
-        return await asyncio.gather(*coroutines)
+    coroutines = [
+        _run_task(http_client, run_ref, task, tasks_state[task.task_id], normalized_document) for task in tasks
+    ]
+    return await asyncio.gather(*coroutines)
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Client for task service calls; share one across runs so connections are kept alive."""
+    return httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_keepalive_connections=32))
 
 
 async def _run_task(
-    run_ref: firestore.DocumentReference,
+    http_client: httpx.AsyncClient,
+    run_ref: firestore.AsyncDocumentReference,
     task: Task,
+    task_state: Dict[str, Any],
     normalized_document: Dict[str, Any],
-    client: httpx.AsyncClient | None = None,
 ) -> str:
+    """Run one task and record its outcome; task_state is the run's in-memory copy and is updated in place."""
     task_path = f"tasks.{task.task_id}"
-    task_state = run_ref.get().to_dict()["tasks"][task.task_id]
     endpoint = _service_endpoint(task.target)
     if not endpoint:
-        run_ref.update(
+        await run_ref.update(
             {
                 f"{task_path}.status": "skipped",
                 f"{task_path}.skippedAt": datetime.now(timezone.utc).isoformat(),
                 f"{task_path}.note": "No endpoint configured.",
             }
         )
+        task_state["status"] = "skipped"
         return "skipped"
 
-    run_ref.update(
-        {
-            f"{task_path}.status": "in-progress",
-            f"{task_path}.startedAt": datetime.now(timezone.utc).isoformat(),
-        }
-    )
+    started_at = datetime.now(timezone.utc).isoformat()
     payload = {
         "tenderId": run_ref.parent.parent.id,
         "taskId": task.task_id,
@@ -93,30 +136,38 @@ async def _run_task(
         "document": normalized_document,
     }
     try:
-        if client is None:
-            async with httpx.AsyncClient(timeout=30) as session:
-                response = await session.post(endpoint, json=payload)
-        else:
-            response = await client.post(endpoint, json=payload)
+        response = await http_client.post(endpoint, json=payload)
         response.raise_for_status()
-        run_ref.update({f"{task_path}.status": "succeeded", f"{task_path}.completedAt": datetime.now(timezone.utc).isoformat()})
+        # One write per attempt: start and completion are recorded together.
+        await run_ref.update(
+            {
+                f"{task_path}.status": "succeeded",
+                f"{task_path}.startedAt": started_at,
+                f"{task_path}.completedAt": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+        task_state["status"] = "succeeded"
         return "succeeded"
     except Exception as exc:  # pragma: no cover - external dependency
+        # Decide from the in-memory count; the stored counter is bumped atomically server-side.
         retries = task_state.get("retries", 0) + 1
-        run_ref.update(
+        status = "retry" if retries < 3 else "failed"
+        await run_ref.update(
             {
-                f"{task_path}.status": "retry" if retries < 3 else "failed",
+                f"{task_path}.status": status,
+                f"{task_path}.startedAt": started_at,
                 f"{task_path}.error": str(exc),
-                f"{task_path}.retries": retries,
+                f"{task_path}.retries": firestore.Increment(1),
                 "status": "running",
                 "updatedAt": datetime.now(timezone.utc).isoformat(),
             }
         )
-        return "retry" if retries < 3 else "failed"
+        task_state.update(status=status, retries=retries)
+        return status
 
 
-def _load_normalized_document(firestore_client: FirestoreClient, tender_id: str) -> Dict[str, Any]:
-    doc = firestore_client.collection(settings.parsed_collection).document(tender_id).get()
+async def _load_normalized_document(firestore_client: FirestoreClient, tender_id: str) -> Dict[str, Any]:
+    doc = await firestore_client.collection(settings.parsed_collection).document(tender_id).get()
     if not doc.exists:
         raise KeyError(f"Normalized document for tender {tender_id} not found.")
     payload = doc.to_dict()
@@ -126,5 +177,5 @@ def _load_normalized_document(firestore_client: FirestoreClient, tender_id: str)
 
 
 def _service_endpoint(task_target: str) -> str | None:
-    return (settings.service_map or {}).get(task_target)
+    return settings.service_map.get(task_target)
 
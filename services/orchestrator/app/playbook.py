@@ -1,17 +1,19 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import time
 from datetime import datetime, timezone
+from itertools import islice
 import re
-from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Sequence, Tuple
+from typing import Callable, Dict, List, Sequence, Tuple
 
-from google.cloud import storage
+import orjson
+from pydantic import TypeAdapter
 
-from .clients import get_storage_client
+from .clients import get_bucket
 from .config import settings
 from .generative import generate_document_answer, has_substantive_answer
 from .models import (
@@ -23,7 +25,14 @@ from .models import (
     RagQueryRequest,
     RagQueryResponse,
 )
-from .rag import execute_vertex_search, import_rag_files, map_rag_files_by_uri, populate_answer_evidence, supplement_answer_evidence_from_contexts
+from .rag import (
+    RetrievedContext,
+    execute_vertex_search,
+    import_rag_files,
+    map_rag_uris_by_name,
+    populate_answer_evidence,
+    supplement_answer_evidence_from_contexts,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +53,7 @@ _DEFAULT_CONFIG: Sequence[Dict[str, object]] = [
             "Return the answer as a JSON array of objects with fields 'label' and 'value' capturing the filled-in identifier."
         ),
         "pageSize": 4,
+        "preferStructured": True,
     },
     {
         "id": "submission_deadlines",
@@ -54,36 +64,43 @@ _DEFAULT_CONFIG: Sequence[Dict[str, object]] = [
             "Return the answer as a JSON array of objects with fields 'label' and 'value'."
         ),
         "pageSize": 10,
+        "preferStructured": True,
     },
 ]
 
 
+_RESULTS_ADAPTER = TypeAdapter(List[RagPlaybookResult])
+
+
 def _playbook_config_path() -> Path:
     if settings.playbook_config_path:
         return Path(settings.playbook_config_path)
     return Path(__file__).resolve().parent.parent / "config" / "playbook_questions.json"
 
 
-@lru_cache()
 def _load_playbook_config() -> Sequence[Dict[str, object]]:
     path = _playbook_config_path()
     try:
-        with path.open(encoding="utf-8") as fp:
-            return json.load(fp)
+        return orjson.loads(path.read_bytes())
     except FileNotFoundError:
         return _DEFAULT_CONFIG
-    except json.JSONDecodeError as exc:
+    except orjson.JSONDecodeError as exc:
         raise RuntimeError(f"Invalid playbook configuration JSON: {path}: {exc}") from exc
 
 
+# Parsed and validated once at import; a broken config fails the deploy instead of every playbook request.
+_DEFAULT_QUESTIONS: Tuple[PlaybookQuestion, ...] = tuple(
+    PlaybookQuestion.model_validate(item) for item in _load_playbook_config()
+)
+
+
 def resolve_playbook_questions(questions: List[PlaybookQuestion] | None) -> List[PlaybookQuestion]:
     if questions:
         return questions
-    definitions = _load_playbook_config()
-    return [PlaybookQuestion(**item) for item in definitions]
+    return list(_DEFAULT_QUESTIONS)
 
 
-def run_playbook(request: RagPlaybookRequest) -> RagPlaybookResponse:
+async def run_playbook(request: RagPlaybookRequest) -> RagPlaybookResponse:
     questions = resolve_playbook_questions(request.questions)
     rag_file_mapping: Dict[str, str] = {}
     rag_file_names: List[str] = []
@@ -91,117 +108,155 @@ def run_playbook(request: RagPlaybookRequest) -> RagPlaybookResponse:
     if request.ragFileIds:
         rag_file_names = list(request.ragFileIds)
     elif request.gcsUris:
-        rag_file_mapping = import_rag_files(request.gcsUris)
+        rag_file_mapping = await asyncio.to_thread(import_rag_files, request.gcsUris)
         rag_file_names = list(rag_file_mapping.values())
     else:
         raise RuntimeError("No ragFileIds or gcsUris provided for playbook execution.")
 
     rag_file_ids_for_query = rag_file_names or None
-    results: List[RagPlaybookResult] = []
-    retrieval_cache: Dict[Tuple[str, str], Tuple[RagQueryResponse, List[object]]] = {}
-
-    total_questions = len(questions)
-    for index, question in enumerate(questions):
-        question_start = time.time()
-        query_page_size = question.page_size or request.pageSize
-        source_uris = list(request.gcsUris) if request.gcsUris else list(rag_file_mapping.keys())
-        if not source_uris and request.ragFileIds:
-            mapping = map_rag_files_by_uri()
-            wanted = set(request.ragFileIds)
-            source_uris = [uri for uri, name in mapping.items() if name in wanted]
-
-        cache_key = (question.id, question.prompt.strip())
-        if cache_key in retrieval_cache:
-            query_response, contexts = retrieval_cache[cache_key]
-        else:
-            query_response, contexts = execute_vertex_search(
-                RagQueryRequest(
-                    tenderId=request.tenderId,
-                    question=question.prompt,
-                    pageSize=query_page_size,
-                    gcsUris=source_uris,
-                    ragFileIds=rag_file_ids_for_query,
+    # Question-invariant: resolved once for the whole run.
+    source_uris: List[str] = list(request.gcsUris) if request.gcsUris else list(rag_file_mapping.keys())
+    if not source_uris and request.ragFileIds:
+        uris_by_name = await asyncio.to_thread(map_rag_uris_by_name, request.ragFileIds)
+        source_uris = [uri for name in request.ragFileIds for uri in uris_by_name.get(name, ())]
+    # Keyed on what each call depends on within this run, so overlapping questions share one in-flight RPC.
+    retrieval_tasks: Dict[Tuple[int, str], "asyncio.Future[Tuple[RagQueryResponse, Sequence[RetrievedContext]]]"] = {}
+    document_answer_tasks: Dict[str, "asyncio.Future[Tuple[List[Dict[str, str]], str]]"] = {}
+    semaphore = asyncio.Semaphore(max(settings.vertex_rag_playbook_concurrency, 1))
+    pacing = settings.vertex_rag_playbook_pacing_seconds
+
+    async def answer_question(index: int, question: PlaybookQuestion) -> RagPlaybookResult:
+        if pacing > 0:
+            # Stagger question starts to smooth quota usage.
+            await asyncio.sleep(index * pacing)
+        async with semaphore:
+            question_start = time.time()
+            query_page_size = question.page_size or request.pageSize
+            prompt = question.prompt.strip()
+            cache_key = (query_page_size, prompt)
+            retrieval = retrieval_tasks.get(cache_key)
+            if retrieval is None:
+                retrieval = asyncio.ensure_future(
+                    asyncio.to_thread(
+                        execute_vertex_search,
+                        RagQueryRequest(
+                            tenderId=request.tenderId,
+                            question=question.prompt,
+                            pageSize=query_page_size,
+                            gcsUris=source_uris,
+                            ragFileIds=rag_file_ids_for_query,
+                        ),
+                    )
                 )
-            )
-            retrieval_cache[cache_key] = (query_response, contexts)
-        rag_answers = query_response.answers or []
-        structured_entries, raw_text = generate_document_answer(
-            question.prompt,
-            source_uris,
-            mode="structured",
-        )
-        filtered_entries = filter_structured_entries(question.id, structured_entries)
-        if not filtered_entries and raw_text:
-            logger.debug(
-                "playbook_raw_structured tender=%s question_id=%s raw_preview=%s",
-                request.tenderId,
-                question.id,
-                raw_text.strip()[:200],
-            )
-            recovered_entries = _recover_entries_from_raw_text(raw_text)
-            if recovered_entries:
-                filtered_entries = filter_structured_entries(question.id, recovered_entries)
-
-        answers: List[RagAnswer]
-        if filtered_entries:
-            formatted_text = format_structured_entries(filtered_entries)
-            citation_list = rag_answers[0].citations if rag_answers else []
-            answers = [
-                RagAnswer(
-                    text=formatted_text,
-                    citations=citation_list,
+                retrieval_tasks[cache_key] = retrieval
+
+            def document_answer() -> "asyncio.Future[Tuple[List[Dict[str, str]], str]]":
+                future = document_answer_tasks.get(prompt)
+                if future is None:
+                    future = asyncio.ensure_future(
+                        asyncio.to_thread(
+                            generate_document_answer,
+                            question.prompt,
+                            source_uris,
+                            mode="structured",
+                            reuse_context=True,
+                        )
+                    )
+                    document_answer_tasks[prompt] = future
+                return future
+
+            rag_is_final = False
+            structured_entries: List[Dict[str, str]] = []
+            raw_text = ""
+            if question.prefer_structured:
+                # Structured extraction wins over RAG here, so both calls are always needed; run them together.
+                (query_response, contexts), (structured_entries, raw_text) = await asyncio.gather(
+                    retrieval, document_answer()
                 )
-            ]
-        elif question.id in STRUCTURED_FALLBACK_MESSAGES:
-            answers = [
-                RagAnswer(
-                    text=STRUCTURED_FALLBACK_MESSAGES[question.id],
-                    citations=[],
+            else:
+                query_response, contexts = await retrieval
+                # A substantive RAG answer is used as-is; only fall back to the Gemini document pass without one.
+                rag_is_final = has_substantive_answer(query_response.answers or []) and _rag_answers_accepted(
+                    question.id, query_response.answers or []
                 )
-            ]
-        elif has_substantive_answer(rag_answers):
-            answers = rag_answers
-        elif raw_text:
-            cleaned_text = raw_text.strip().strip("`").strip()
-            answers = [
-                RagAnswer(
-                    text=cleaned_text or "No relevant context found.",
-                    citations=rag_answers[0].citations if rag_answers else [],
+                if not rag_is_final:
+                    structured_entries, raw_text = await document_answer()
+            rag_answers = query_response.answers or []
+            filtered_entries = filter_structured_entries(question.id, structured_entries)
+            if not filtered_entries and raw_text:
+                logger.debug(
+                    "playbook_raw_structured tender=%s question_id=%s raw_preview=%s",
+                    request.tenderId,
+                    question.id,
+                    raw_text.strip()[:200],
                 )
-            ]
-        else:
-            answers = [RagAnswer(text="No relevant context found.", citations=[])]
-
-        populate_answer_evidence(answers, query_response.documents)
-        supplement_answer_evidence_from_contexts(answers, contexts)
-
-        duration = time.time() - question_start
-        logger.info(
-            "playbook_question_complete tender=%s question_id=%s question=\"%s\" duration=%.3f answer_len=%s documents=%s",
-            request.tenderId,
-            question.id,
-            question.display,
-            duration,
-            len(answers[0].text) if answers else 0,
-            len(query_response.documents),
-        )
-        results.append(
-            RagPlaybookResult(
+                recovered_entries = _recover_entries_from_raw_text(raw_text)
+                if recovered_entries:
+                    filtered_entries = filter_structured_entries(question.id, recovered_entries)
+
+            answers: List[RagAnswer]
+            if rag_is_final:
+                answers = rag_answers
+            elif filtered_entries:
+                formatted_text = format_structured_entries(filtered_entries)
+                citation_list = rag_answers[0].citations if rag_answers else []
+                answers = [
+                    RagAnswer(
+                        text=formatted_text,
+                        citations=citation_list,
+                    )
+                ]
+            elif question.id in STRUCTURED_FALLBACK_MESSAGES:
+                answers = [
+                    RagAnswer(
+                        text=STRUCTURED_FALLBACK_MESSAGES[question.id],
+                        citations=[],
+                    )
+                ]
+            elif has_substantive_answer(rag_answers):
+                answers = rag_answers
+            elif raw_text:
+                cleaned_text = raw_text.strip().strip("`").strip()
+                answers = [
+                    RagAnswer(
+                        text=cleaned_text or "No relevant context found.",
+                        citations=rag_answers[0].citations if rag_answers else [],
+                    )
+                ]
+            else:
+                answers = [RagAnswer(text="No relevant context found.", citations=[])]
+
+            populate_answer_evidence(answers, query_response.documents)
+            supplement_answer_evidence_from_contexts(answers, contexts)
+
+            duration = time.time() - question_start
+            logger.info(
+                "playbook_question_complete tender=%s question_id=%s question=\"%s\" duration=%.3f answer_len=%s documents=%s",
+                request.tenderId,
+                question.id,
+                question.display,
+                duration,
+                len(answers[0].text) if answers else 0,
+                len(query_response.documents),
+            )
+            return RagPlaybookResult(
                 questionId=question.id,
                 question=question.display,
                 answers=answers,
                 documents=query_response.documents,
             )
-        )
-        if settings.vertex_rag_playbook_pacing_seconds > 0 and index < total_questions - 1:
-            time.sleep(settings.vertex_rag_playbook_pacing_seconds)
+
+    results: List[RagPlaybookResult] = list(
+        await asyncio.gather(*(answer_question(index, question) for index, question in enumerate(questions)))
+    )
 
     payload = {
         "tenderId": request.tenderId,
         "generatedAt": datetime.now(timezone.utc).isoformat(),
-        "results": [result.model_dump(mode="json") for result in results],
+        # Pre-encoded in one native pass; orjson splices the bytes in as-is.
+        "results": orjson.Fragment(_RESULTS_ADAPTER.dump_json(results)),
     }
-    output_uri = write_results_to_gcs(request.tenderId, payload)
+    output_uri = await asyncio.to_thread(write_results_to_gcs, request.tenderId, payload)
 
     if rag_file_mapping:
         rag_file_handles = [
@@ -217,20 +272,18 @@ def run_playbook(request: RagPlaybookRequest) -> RagPlaybookResponse:
 
 
 def write_results_to_gcs(tender_id: str, payload: Dict[str, object]) -> str:
-    client: storage.Client = get_storage_client()
-    bucket = client.bucket(settings.parsed_bucket)
+    bucket = get_bucket(settings.parsed_bucket)
     timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
     object_name = f"{tender_id}/rag/results-{timestamp}.json"
     blob = bucket.blob(object_name)
     blob.cache_control = "no-store"
-    blob.upload_from_string(
-        json.dumps(payload, ensure_ascii=False, indent=2),
-        content_type="application/json",
-    )
+    # Compact UTF-8 bytes straight from orjson: no intermediate str and no indentation padding.
+    blob.upload_from_string(orjson.dumps(payload), content_type="application/json")
     return f"gs://{settings.parsed_bucket}/{object_name}"
 
 
 def filter_structured_entries(question_id: str, entries: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    accepts = _ENTRY_CHECKS.get(question_id)
     filtered: List[Dict[str, str]] = []
     seen: set[Tuple[str, str]] = set()
     for entry in entries:
@@ -238,23 +291,10 @@ def filter_structured_entries(question_id: str, entries: List[Dict[str, str]]) -
         value = str(entry.get("value", "") or "").strip()
         if not value:
             continue
-        if "__" in value or value.replace("_", "").strip() == "":
+        if "__" in value or not value.replace("_", "").strip():
+            continue
+        if accepts is not None and not accepts(value):
             continue
-        if question_id == "document_id":
-            if not any(char.isalnum() for char in value):
-                continue
-        if question_id in {"submission_deadlines", "prebid_meeting", "technical_bid_opening"}:
-            if not _looks_like_schedule(value):
-                continue
-        if question_id == "financial_bid_opening":
-            normalized_value = value.lower()
-            if not (
-                _looks_like_schedule(value)
-                or "notified" in normalized_value
-                or "communicated" in normalized_value
-                or "intimated" in normalized_value
-            ):
-                continue
         key = (label.lower(), value.lower())
         if key in seen:
             continue
@@ -263,6 +303,18 @@ def filter_structured_entries(question_id: str, entries: List[Dict[str, str]]) -
     return filtered
 
 
+def _rag_answers_accepted(question_id: str, answers: List[RagAnswer]) -> bool:
+    """Whether substantive RAG answers may replace the document pass for this question.
+
+    Questions with a fallback message never surface free-form RAG text on the document path (they
+    answer with filtered entries or the message), so their RAG answer must pass the same entry check.
+    """
+    accepts = _ENTRY_CHECKS.get(question_id)
+    if accepts is None or question_id not in STRUCTURED_FALLBACK_MESSAGES:
+        return True
+    return any(accepts(text) for answer in answers if (text := (answer.text or "").strip()))
+
+
 def _recover_entries_from_raw_text(raw_text: str) -> List[Dict[str, str]]:
     """Best-effort recovery of label/value pairs from raw Gemini output."""
     if not raw_text:
@@ -296,48 +348,48 @@ def _recover_entries_from_raw_text(raw_text: str) -> List[Dict[str, str]]:
 
 
 def format_structured_entries(entries: List[Dict[str, str]]) -> str:
-    lines: List[str] = []
-    for entry in entries:
-        label = entry.get("label", "").strip()
-        value = entry.get("value", "").strip()
-        if label and value:
-            lines.append(f"{label}: {value}")
-        else:
-            lines.append(value or label)
-    return "\n".join(lines)
-
-
-MONTH_TOKENS = {
-    "jan",
-    "feb",
-    "mar",
-    "apr",
-    "may",
-    "jun",
-    "jul",
-    "aug",
-    "sep",
-    "sept",
-    "oct",
-    "nov",
-    "dec",
-}
+    """Render entries from filter_structured_entries (already stripped) as "label: value" lines."""
+    return "\n".join(
+        f"{entry['label']}: {entry['value']}" if entry["label"] and entry["value"] else entry["value"] or entry["label"]
+        for entry in entries
+    )
 
-DATE_REGEXPS = [
-    re.compile(r"\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b"),
-    re.compile(r"\b\d{4}[/-]\d{1,2}[/-]\d{1,2}\b"),
-]
 
-TIME_REGEX = re.compile(r"\b\d{1,2}:\d{2}\b")
+# Month names (matched as substrings, e.g. "15-Mar-2025") and HH:MM times, searched in the lowered value.
+_MONTH_OR_TIME_RE = re.compile(r"jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec|\b\d{1,2}:\d{2}\b")
+_DATE_RE = re.compile(r"\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b|\b\d{4}[/-]\d{1,2}[/-]\d{1,2}\b")
 
 
 def _looks_like_schedule(value: str) -> bool:
-    normalized = value.lower()
-    if any(month in normalized for month in MONTH_TOKENS):
-        return True
-    if TIME_REGEX.search(normalized):
+    if _MONTH_OR_TIME_RE.search(value.lower()) or _DATE_RE.search(value):
         return True
-    if any(regex.search(value) for regex in DATE_REGEXPS):
-        return True
-    digits = sum(char.isdigit() for char in value)
-    return digits >= 4
+    # At least four str.isdigit() characters (superscripts and circled digits included); stop at the fourth.
+    return next(islice(filter(str.isdigit, value), 3, None), None) is not None
+
+
+# Unicode letters and digits, i.e. str.isalnum() for any character.
+_ALNUM_RE = re.compile(r"[^\W_]")
+
+
+def _has_alnum(value: str) -> bool:
+    return _ALNUM_RE.search(value) is not None
+
+
+def _is_schedule_or_notice(value: str) -> bool:
+    value_lower = value.lower()
+    return (
+        _looks_like_schedule(value)
+        or "notified" in value_lower
+        or "communicated" in value_lower
+        or "intimated" in value_lower
+    )
+
+
+# Per-question acceptance check, resolved once per filter call; questions not listed accept any value.
+_ENTRY_CHECKS: Dict[str, Callable[[str], bool]] = {
+    "document_id": _has_alnum,
+    "submission_deadlines": _looks_like_schedule,
+    "prebid_meeting": _looks_like_schedule,
+    "technical_bid_opening": _looks_like_schedule,
+    "financial_bid_opening": _is_schedule_or_notice,
+}
@@ -1,29 +1,149 @@
 from __future__ import annotations
 
 import logging
-import statistics
+import math
+import operator
 import time
-from collections.abc import Iterable
-from threading import Lock
-from typing import Dict, List, Tuple, Optional, Set
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import Event, Lock
+from typing import Callable, Deque, Dict, List, Sequence, Tuple, Optional, Set
 
 from google.api_core import exceptions as google_exceptions
+from google.api_core import retry
 from google.protobuf.json_format import MessageToDict
+from vertexai.language_models import TextEmbeddingModel
 
 try:
     from google.cloud import aiplatform_v1beta1  # type: ignore
 except ImportError:  # pragma: no cover - optional dependency
     aiplatform_v1beta1 = None  # type: ignore[assignment]
 
-from .clients import get_rag_data_client, get_rag_service_client
+from .clients import ensure_vertexai_initialized, get_rag_data_client, get_rag_service_client
 from .config import settings
 from .models import AnswerEvidence, RagDocument, RagQueryRequest, RagQueryResponse, RagAnswer, RagCitation
-from .generative import run_generative_agent
+from .generative import parse_resource_path, run_generative_agent
 
 logger = logging.getLogger(__name__)
+# Largest page the RAG API accepts; fewer sequential list RPCs on big corpora.
+_RAG_FILES_PAGE_SIZE = 1000
+# Partial response: only the fields used to map RagFiles back to their GCS URIs.
+_RAG_FILES_FIELD_MASK = (("x-goog-fieldmask", "rag_files.name,rag_files.gcs_source,next_page_token"),)
 _rag_file_filter_supported: bool = True
-_retrieval_cache: Dict[Tuple, Tuple[float, List[object]]] = {}
-_cache_lock: Lock = Lock()
+# RetrieveContexts has no default retry; absorb brief UNAVAILABLE blips (channel resets, GFE restarts).
+_RETRIEVE_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(google_exceptions.ServiceUnavailable),
+    initial=0.5,
+    maximum=4.0,
+    multiplier=2.0,
+    timeout=30.0,
+)
+# Followers of an in-flight retrieval give up after the leader's retry budget rather than pin a thread.
+_INFLIGHT_WAIT_SECONDS = _RETRIEVE_RETRY.timeout
+# (fetched_at, corpus_path, (gcs_uri, rag_file_name) pairs) from the last ListRagFiles pass.
+_rag_files_listing: Optional[Tuple[float, str, Tuple[Tuple[str, str], ...]]] = None
+_rag_files_listing_lock: Lock = Lock()
+# Metadata keys that may carry a page label, in lookup order.
+_PAGE_LABEL_KEYS = (
+    "page",
+    "pageNumber",
+    "page_number",
+    "page_label",
+    "pageLabel",
+    "page_label_text",
+    "pageNumbers",
+    "page_numbers",
+)
+# Paraphrase reuse: normalised question embeddings per retrieval scope (tender, page size, sorted
+# URIs and RagFile IDs), LRU over scopes, newest-last within a scope.
+_SEMANTIC_ENTRIES_PER_SCOPE = 32
+_semantic_cache: "OrderedDict[Tuple, Deque[Tuple[float, Tuple[float, ...], Tuple[RetrievedContext, ...]]]]" = (
+    OrderedDict()
+)
+_semantic_lock: Lock = Lock()
+# The retrieval cache is split by key hash so unrelated queries never contend on one lock.
+_MAX_CACHE_SHARDS = 16
+
+
+@dataclass(frozen=True, slots=True)
+class RetrievedContext:
+    """The fields every consumer reads from a retrieved RAG context, extracted once per retrieval."""
+
+    text: str
+    text_lower: str
+    source_uri: str
+    distance: Optional[float]
+    page_label: Optional[str]
+
+
+def _to_retrieved_context(ctx: object) -> RetrievedContext:
+    text = getattr(ctx, "text", "") or ""
+    return RetrievedContext(
+        text=text,
+        text_lower=text.lower(),
+        source_uri=getattr(ctx, "source_uri", "") or "",
+        distance=getattr(ctx, "distance", None),
+        page_label=_extract_page_label(ctx),
+    )
+
+
+class _InflightRetrieval:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.result: Optional[Tuple[RetrievedContext, ...]] = None
+        self.error: Optional[BaseException] = None
+
+
+class _CacheShard:
+    __slots__ = ("lock", "entries", "inflight", "max_entries")
+
+    def __init__(self, max_entries: int) -> None:
+        self.lock = Lock()
+        self.max_entries = max_entries
+        # LRU order: least recently used first.
+        self.entries: "OrderedDict[Tuple, Tuple[float, Tuple[RetrievedContext, ...]]]" = OrderedDict()
+        self.inflight: Dict[Tuple, _InflightRetrieval] = {}
+
+
+def _make_cache_shards(max_entries: int) -> Tuple[_CacheShard, ...]:
+    """Split the retrieval cache capacity over up to _MAX_CACHE_SHARDS shards, exactly max_entries in total.
+
+    Eviction is per shard, so a burst of keys that hash to one shard evicts at that shard's share
+    of the capacity rather than at max_entries.
+    """
+    max_entries = max(max_entries, 1)
+    count = min(_MAX_CACHE_SHARDS, max_entries)
+    share, extra = divmod(max_entries, count)
+    return tuple(_CacheShard(share + (index < extra)) for index in range(count))
+
+
+_cache_shards = _make_cache_shards(settings.vertex_rag_cache_max_entries)
+
+
+def _cache_shard(key: Tuple) -> _CacheShard:
+    return _cache_shards[hash(key) % len(_cache_shards)]
+
+
+def _build_chunking_kwargs(chunk_size: int, chunk_overlap: int) -> Dict[str, int]:
+    if chunk_size <= 0:
+        return {}
+    kwargs: Dict[str, int] = {"chunk_size": chunk_size}
+    if chunk_overlap > 0:
+        kwargs["chunk_overlap"] = chunk_overlap
+    return kwargs
+
+
+# Settings are read once per process, so the chunking config is fixed at import.
+_CHUNKING_KWARGS = _build_chunking_kwargs(
+    settings.vertex_rag_chunk_size_tokens,
+    settings.vertex_rag_chunk_overlap_tokens,
+)
 
 
 def rag_file_name_to_id(resource_name: str) -> str:
@@ -32,12 +152,16 @@ def rag_file_name_to_id(resource_name: str) -> str:
     return resource_name.rsplit("/", 1)[-1]
 
 
-def map_rag_files_by_uri() -> Dict[str, str]:
+def _iter_rag_file_uris() -> Iterator[Tuple[str, str]]:
+    """Yield (gcs_uri, rag_file_name) for every RagFile in the corpus."""
     if not settings.vertex_rag_corpus_path:
-        return {}
+        return
     client = get_rag_data_client()
-    mapping: Dict[str, str] = {}
-    for rag_file in client.list_rag_files(parent=settings.vertex_rag_corpus_path):
+    list_request = aiplatform_v1beta1.ListRagFilesRequest(  # type: ignore[attr-defined]
+        parent=settings.vertex_rag_corpus_path,
+        page_size=_RAG_FILES_PAGE_SIZE,
+    )
+    for rag_file in client.list_rag_files(request=list_request, metadata=_RAG_FILES_FIELD_MASK):
         gcs_source = getattr(rag_file, "gcs_source", None)
         if not gcs_source:
             continue
@@ -51,27 +175,63 @@ def map_rag_files_by_uri() -> Dict[str, str]:
                 candidates = [str(item) for item in uris_attr]
         for uri in candidates:
             if uri:
-                mapping[str(uri)] = rag_file.name
-    return mapping
+                yield str(uri), rag_file.name
+
+
+def _rag_file_uri_pairs(refresh: bool = False) -> Tuple[Tuple[str, str], ...]:
+    """(gcs_uri, rag_file_name) pairs for the corpus, cached for VERTEX_RAG_FILES_MAP_TTL_SECONDS."""
+    global _rag_files_listing
+    ttl = settings.vertex_rag_files_map_ttl_seconds
+    if ttl <= 0:
+        return tuple(_iter_rag_file_uris())
+    corpus = settings.vertex_rag_corpus_path
+    # Held across the listing so concurrent misses share a single ListRagFiles pass.
+    with _rag_files_listing_lock:
+        entry = _rag_files_listing
+        if refresh or entry is None or entry[1] != corpus or time.time() - entry[0] >= ttl:
+            entry = (time.time(), corpus, tuple(_iter_rag_file_uris()))
+            _rag_files_listing = entry
+        return entry[2]
+
+
+def _invalidate_rag_files_listing() -> None:
+    global _rag_files_listing
+    with _rag_files_listing_lock:
+        _rag_files_listing = None
+
+
+def map_rag_uris_by_name(required: Iterable[str] = ()) -> Dict[str, List[str]]:
+    """Map each RagFile name in the corpus to its source URIs.
+
+    RagFiles imported by the ingest worker do not invalidate the cached listing, so it is
+    refreshed once when any of the required names is missing.
+    """
+    refresh = False
+    while True:
+        mapping: Dict[str, List[str]] = {}
+        for uri, name in _rag_file_uri_pairs(refresh=refresh):
+            mapping.setdefault(name, []).append(uri)
+        if refresh or all(name in mapping for name in required):
+            return mapping
+        refresh = True
 
 
 def import_rag_files(gcs_uris: List[str]) -> Dict[str, str]:
     if not gcs_uris:
         return {}
+    # Drop repeated URIs (order preserved) so a file is never imported twice.
+    gcs_uris = list(dict.fromkeys(gcs_uris))
     client = get_rag_data_client()
     import_config: Dict[str, object] = {"gcs_source": {"uris": gcs_uris}}
-    if settings.vertex_rag_chunk_size_tokens > 0:
-        chunk_kwargs: Dict[str, int] = {"chunk_size": settings.vertex_rag_chunk_size_tokens}
-        if settings.vertex_rag_chunk_overlap_tokens > 0:
-            chunk_kwargs["chunk_overlap"] = settings.vertex_rag_chunk_overlap_tokens
-        import_config["rag_file_chunking_config"] = aiplatform_v1beta1.RagFileChunkingConfig(**chunk_kwargs)  # type: ignore[attr-defined]
+    if _CHUNKING_KWARGS:
+        import_config["rag_file_chunking_config"] = aiplatform_v1beta1.RagFileChunkingConfig(**_CHUNKING_KWARGS)  # type: ignore[attr-defined]
     request = aiplatform_v1beta1.ImportRagFilesRequest(  # type: ignore[attr-defined]
         parent=settings.vertex_rag_corpus_path,
         import_rag_files_config=import_config,
     )
     operation = client.import_rag_files(request=request)
     operation.result()
-    after = map_rag_files_by_uri()
+    after = dict(_rag_file_uri_pairs(refresh=True))
     resolved: Dict[str, str] = {}
     for uri in gcs_uris:
         name = after.get(uri)
@@ -82,55 +242,111 @@ def import_rag_files(gcs_uris: List[str]) -> Dict[str, str]:
     return resolved
 
 
+@lru_cache(maxsize=1024)
 def _get_cache_key(
     tender_id: str,
     question: str,
     page_size: int,
-    gcs_uris: Iterable[str],
-    rag_file_ids: Iterable[str],
+    gcs_uris: Tuple[str, ...],
+    rag_file_ids: Tuple[str, ...],
 ) -> Tuple:
+    # Memoised: a playbook re-asks the same questions over the same files, so the
+    # lower/sort normalisation is paid once per distinct request shape.
     normalized_question = question.strip().lower()
     uris_tuple = tuple(sorted(gcs_uris))
     rag_ids_tuple = tuple(sorted(rag_file_ids))
     return (tender_id, normalized_question, page_size, uris_tuple, rag_ids_tuple)
 
 
-def _get_cached_contexts(key: Tuple) -> List[object] | None:
+def _get_cached_contexts(key: Tuple) -> Tuple[RetrievedContext, ...] | None:
     ttl = settings.vertex_rag_cache_ttl_seconds
     if ttl <= 0:
         return None
     now = time.time()
-    with _cache_lock:
-        entry = _retrieval_cache.get(key)
+    shard = _cache_shard(key)
+    with shard.lock:
+        entry = shard.entries.get(key)
         if not entry:
             return None
         timestamp, contexts = entry
         if now - timestamp > ttl:
-            _retrieval_cache.pop(key, None)
+            shard.entries.pop(key, None)
             return None
+        shard.entries.move_to_end(key)
         return contexts
 
 
-def _store_cached_contexts(key: Tuple, contexts: List[object]) -> None:
+def _store_cached_contexts(key: Tuple, contexts: Tuple[RetrievedContext, ...]) -> None:
     ttl = settings.vertex_rag_cache_ttl_seconds
     if ttl <= 0:
         return
     now = time.time()
-    with _cache_lock:
-        _retrieval_cache[key] = (now, contexts)
-        max_entries = max(settings.vertex_rag_cache_max_entries, 1)
-        if len(_retrieval_cache) > max_entries:
-            # Evict oldest entry (other than the one we just set)
-            oldest_key = None
-            oldest_ts = now
-            for candidate_key, (candidate_ts, _) in _retrieval_cache.items():
-                if candidate_key == key:
-                    continue
-                if oldest_key is None or candidate_ts < oldest_ts:
-                    oldest_key = candidate_key
-                    oldest_ts = candidate_ts
-            if oldest_key is not None:
-                _retrieval_cache.pop(oldest_key, None)
+    shard = _cache_shard(key)
+    with shard.lock:
+        shard.entries[key] = (now, contexts)
+        shard.entries.move_to_end(key)
+        while len(shard.entries) > shard.max_entries:
+            shard.entries.popitem(last=False)
+
+
+@lru_cache(maxsize=2)
+def _get_embedding_model(model_id: str) -> TextEmbeddingModel:
+    return TextEmbeddingModel.from_pretrained(model_id)
+
+
+def _embed_question(project_id: str, location: str, question: str) -> Optional[Tuple[float, ...]]:
+    """Unit-length embedding of the question, or None when it cannot be computed."""
+    try:
+        ensure_vertexai_initialized(project_id, location)
+        model = _get_embedding_model(settings.vertex_rag_embedding_model)
+        values = model.get_embeddings([question.strip()])[0].values
+    except Exception as exc:  # pragma: no cover - embedding is an optimisation only
+        logger.warning("Question embedding failed; skipping semantic cache lookup: %s", exc)
+        return None
+    norm = math.sqrt(sum(value * value for value in values))
+    if not norm:
+        return None
+    return tuple(value / norm for value in values)
+
+
+def _get_semantic_contexts(scope: Tuple, embedding: Tuple[float, ...]) -> Tuple[RetrievedContext, ...] | None:
+    """Contexts cached for the most similar earlier question in scope, if it clears the threshold."""
+    ttl = settings.vertex_rag_cache_ttl_seconds
+    if ttl <= 0:
+        return None
+    with _semantic_lock:
+        entries = _semantic_cache.get(scope)
+        if not entries:
+            return None
+        _semantic_cache.move_to_end(scope)
+        candidates = tuple(entries)
+    now = time.time()
+    best_score = settings.vertex_rag_semantic_cache_threshold
+    best: Tuple[RetrievedContext, ...] | None = None
+    for timestamp, vector, contexts in candidates:
+        if now - timestamp > ttl:
+            continue
+        # Both vectors are unit length, so the dot product is the cosine similarity.
+        score = sum(map(operator.mul, vector, embedding))
+        if score >= best_score:
+            best_score, best = score, contexts
+    return best
+
+
+def _store_semantic_contexts(
+    scope: Tuple, embedding: Tuple[float, ...], contexts: Tuple[RetrievedContext, ...]
+) -> None:
+    if settings.vertex_rag_cache_ttl_seconds <= 0:
+        return
+    max_scopes = max(settings.vertex_rag_cache_max_entries, 1)
+    with _semantic_lock:
+        entries = _semantic_cache.get(scope)
+        if entries is None:
+            entries = _semantic_cache[scope] = deque(maxlen=_SEMANTIC_ENTRIES_PER_SCOPE)
+        _semantic_cache.move_to_end(scope)
+        entries.append((time.time(), embedding, contexts))
+        while len(_semantic_cache) > max_scopes:
+            _semantic_cache.popitem(last=False)
 
 
 def delete_rag_files(rag_file_names: List[str]) -> Tuple[List[str], List[str]]:
@@ -139,51 +355,127 @@ def delete_rag_files(rag_file_names: List[str]) -> Tuple[List[str], List[str]]:
     client = get_rag_data_client()
     deleted: List[str] = []
     errors: List[str] = []
-    for name in rag_file_names:
+
+    def _delete(name: str) -> Optional[Exception]:
         try:
             client.delete_rag_file(name=name)
-            deleted.append(name)
         except Exception as exc:  # pragma: no cover - best effort cleanup
-            logger.warning("Failed to delete rag file %s: %s", name, exc)
-            errors.append(f"{name}: {exc}")
-    return deleted, errors
-
-
-def _extract_location_from_path(resource_path: str) -> str | None:
-    if not resource_path:
-        return None
-    marker = "/locations/"
-    start = resource_path.find(marker)
-    if start == -1:
+            return exc
         return None
-    start += len(marker)
-    end = resource_path.find("/", start)
-    location = resource_path[start:] if end == -1 else resource_path[start:end]
-    return location or None
 
-
-def _extract_project_from_resource(resource_path: str) -> str | None:
-    if not resource_path:
-        return None
-    marker = "projects/"
-    start = resource_path.find(marker)
-    if start == -1:
-        return None
-    start += len(marker)
-    end = resource_path.find("/", start)
-    project = resource_path[start:] if end == -1 else resource_path[start:end]
-    return project or None
+    # Deletes are independent unary RPCs; overlap a bounded number of round trips.
+    workers = max(1, min(settings.vertex_rag_delete_concurrency, len(rag_file_names)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, exc in zip(rag_file_names, executor.map(_delete, rag_file_names)):
+            if exc is None:
+                deleted.append(name)
+            else:
+                logger.warning("Failed to delete rag file %s: %s", name, exc)
+                errors.append(f"{name}: {exc}")
+    if deleted:
+        _invalidate_rag_files_listing()
+    return deleted, errors
 
 
-def execute_vertex_search(request: RagQueryRequest) -> Tuple[RagQueryResponse, List[object]]:
+def _retrieve_contexts(
+    client: object,
+    parent: str,
+    rag_query: object,
+    vertex_rag_store: object,
+    filtered_by_rag_file_ids: bool,
+    cache_key: Tuple,
+) -> Optional[Tuple[RetrievedContext, ...]]:
+    """Run retrieve_contexts and cache non-empty results; None means retrieval is not enabled for the corpus."""
     global _rag_file_filter_supported
+    retrieve_request = aiplatform_v1beta1.RetrieveContextsRequest(  # type: ignore[attr-defined]
+        parent=parent,
+        query=rag_query,
+        vertex_rag_store=vertex_rag_store,
+    )
+    try:
+        response = client.retrieve_contexts(request=retrieve_request, retry=_RETRIEVE_RETRY)  # type: ignore[attr-defined]
+    except google_exceptions.MethodNotImplemented as exc:
+        if filtered_by_rag_file_ids and _rag_file_filter_supported:
+            _rag_file_filter_supported = False
+            logger.warning(
+                "Vertex RAG retrieve_contexts does not support ragFileIds filter; disabling filter. Error: %s",
+                exc,
+            )
+            retry_store = aiplatform_v1beta1.RetrieveContextsRequest.VertexRagStore(  # type: ignore[attr-defined]
+                rag_resources=[
+                    aiplatform_v1beta1.RetrieveContextsRequest.VertexRagStore.RagResource(  # type: ignore[attr-defined]
+                        rag_corpus=settings.vertex_rag_corpus_path,
+                    )
+                ]
+            )
+            retry_request = aiplatform_v1beta1.RetrieveContextsRequest(  # type: ignore[attr-defined]
+                parent=parent,
+                query=rag_query,
+                vertex_rag_store=retry_store,
+            )
+            try:
+                response = client.retrieve_contexts(request=retry_request, retry=_RETRIEVE_RETRY)  # type: ignore[attr-defined]
+            except google_exceptions.MethodNotImplemented as inner_exc:
+                logger.warning(
+                    "Vertex RAG retrieve_contexts not enabled for corpus %s; returning empty context. Error: %s",
+                    settings.vertex_rag_corpus_path,
+                    inner_exc,
+                )
+                return None
+        else:
+            logger.warning(
+                "Vertex RAG retrieve_contexts not enabled for corpus %s; returning empty context. Error: %s",
+                settings.vertex_rag_corpus_path,
+                exc,
+            )
+            return None
+
+    contexts = tuple(_to_retrieved_context(ctx) for ctx in getattr(response.contexts, "contexts", ()))
+    if contexts:
+        _store_cached_contexts(cache_key, contexts)
+    return contexts
+
+
+def _singleflight_retrieve(
+    key: Tuple, fetch: Callable[[], Optional[Tuple[RetrievedContext, ...]]]
+) -> Optional[Tuple[RetrievedContext, ...]]:
+    """Run fetch once per key at a time; concurrent callers with the same key wait for and share its result."""
+    shard = _cache_shard(key)
+    with shard.lock:
+        call = shard.inflight.get(key)
+        leader = call is None
+        if call is None:
+            call = _InflightRetrieval()
+            shard.inflight[key] = call
+    if not leader:
+        if not call.done.wait(_INFLIGHT_WAIT_SECONDS):
+            raise google_exceptions.DeadlineExceeded("Timed out waiting for an identical in-flight retrieval.")
+        if call.error is not None:
+            raise call.error
+        return call.result
+    try:
+        # A previous leader may have filled the cache between our miss and registering.
+        cached = _get_cached_contexts(key)
+        call.result = cached if cached is not None else fetch()
+        return call.result
+    except BaseException as exc:
+        call.error = exc
+        raise
+    finally:
+        with shard.lock:
+            shard.inflight.pop(key, None)
+        call.done.set()
+
+
+def execute_vertex_search(request: RagQueryRequest) -> Tuple[RagQueryResponse, Sequence[RetrievedContext]]:
     client = get_rag_service_client()
     if not settings.vertex_rag_corpus_path:
         raise RuntimeError("VERTEX_RAG_CORPUS_PATH is not configured.")
-    location = settings.vertex_rag_location or _extract_location_from_path(settings.vertex_rag_corpus_path)
+    path_project, path_location = parse_resource_path(settings.vertex_rag_corpus_path)
+    location = settings.vertex_rag_location or path_location
     if not location:
         raise RuntimeError("Unable to determine Vertex RAG location. Set VERTEX_RAG_CORPUS_LOCATION.")
-    project_id = settings.project_id or _extract_project_from_resource(settings.vertex_rag_corpus_path)
+    project_id = settings.project_id or path_project
     if not project_id:
         raise RuntimeError("Unable to determine GCP project for Vertex RAG requests.")
 
@@ -193,6 +485,18 @@ def execute_vertex_search(request: RagQueryRequest) -> Tuple[RagQueryResponse, L
 
     cache_key = _get_cache_key(request.tenderId, request.question, page_size, initial_gcs_uris, initial_rag_file_ids)
     cached_contexts = _get_cached_contexts(cache_key)
+    # Opt-in: a paraphrase of an earlier question over the same scope reuses its contexts.
+    semantic_scope = (
+        request.tenderId,
+        page_size,
+        tuple(sorted(initial_gcs_uris)),
+        tuple(sorted(initial_rag_file_ids)),
+    )
+    question_embedding: Optional[Tuple[float, ...]] = None
+    if cached_contexts is None and settings.vertex_rag_semantic_cache_threshold > 0:
+        question_embedding = _embed_question(project_id, location, request.question)
+        if question_embedding is not None:
+            cached_contexts = _get_semantic_contexts(semantic_scope, question_embedding)
     cache_hit = cached_contexts is not None
 
     rag_resource = aiplatform_v1beta1.RetrieveContextsRequest.VertexRagStore.RagResource(  # type: ignore[attr-defined]
@@ -203,12 +507,6 @@ def execute_vertex_search(request: RagQueryRequest) -> Tuple[RagQueryResponse, L
         rag_file_ids = [rag_file_name_to_id(rag_id) for rag_id in initial_rag_file_ids if rag_id]
         if rag_file_ids and _rag_file_filter_supported:
             rag_resource.rag_file_ids.extend(rag_file_ids)
-    effective_gcs_uris: List[str] = list(initial_gcs_uris)
-    if not effective_gcs_uris and initial_rag_file_ids:
-        mapping = map_rag_files_by_uri()
-        for uri, name in mapping.items():
-            if name in initial_rag_file_ids and uri not in effective_gcs_uris:
-                effective_gcs_uris.append(uri)
     vertex_rag_store = aiplatform_v1beta1.RetrieveContextsRequest.VertexRagStore(  # type: ignore[attr-defined]
         rag_resources=[rag_resource]
     )
@@ -217,89 +515,33 @@ def execute_vertex_search(request: RagQueryRequest) -> Tuple[RagQueryResponse, L
         similarity_top_k=page_size,
     )
     parent = f"projects/{project_id}/locations/{location}"
-    retrieve_request = aiplatform_v1beta1.RetrieveContextsRequest(  # type: ignore[attr-defined]
-        parent=parent,
-        query=rag_query,
-        vertex_rag_store=vertex_rag_store,
-    )
-    contexts: List[object]
+    # Cached and shared contexts are immutable tuples; everything downstream only reads them.
+    contexts: Tuple[RetrievedContext, ...]
     start_time = time.time()
     if cached_contexts is not None:
-        contexts = list(cached_contexts)
+        contexts = cached_contexts
     else:
-        try:
-            response = client.retrieve_contexts(request=retrieve_request)
-        except google_exceptions.MethodNotImplemented as exc:
-            if rag_file_ids and _rag_file_filter_supported:
-                _rag_file_filter_supported = False
-                logger.warning(
-                    "Vertex RAG retrieve_contexts does not support ragFileIds filter; disabling filter. Error: %s",
-                    exc,
-                )
-                retry_store = aiplatform_v1beta1.RetrieveContextsRequest.VertexRagStore(  # type: ignore[attr-defined]
-                    rag_resources=[
-                        aiplatform_v1beta1.RetrieveContextsRequest.VertexRagStore.RagResource(  # type: ignore[attr-defined]
-                            rag_corpus=settings.vertex_rag_corpus_path,
-                        )
-                    ]
-                )
-                retry_request = aiplatform_v1beta1.RetrieveContextsRequest(  # type: ignore[attr-defined]
-                    parent=parent,
-                    query=rag_query,
-                    vertex_rag_store=retry_store,
-                )
-                try:
-                    response = client.retrieve_contexts(request=retry_request)
-                except google_exceptions.MethodNotImplemented as inner_exc:
-                    logger.warning(
-                        "Vertex RAG retrieve_contexts not enabled for corpus %s; returning empty context. Error: %s",
-                        settings.vertex_rag_corpus_path,
-                        inner_exc,
-                    )
-                    return RagQueryResponse(answers=[], documents=[]), []
-            else:
-                logger.warning(
-                    "Vertex RAG retrieve_contexts not enabled for corpus %s; returning empty context. Error: %s",
-                    settings.vertex_rag_corpus_path,
-                    exc,
-                )
-                return RagQueryResponse(answers=[], documents=[]), []
-
-        contexts = list(getattr(response.contexts, "contexts", []))
-        if contexts:
-            _store_cached_contexts(cache_key, contexts)
+        fetched = _singleflight_retrieve(
+            cache_key,
+            lambda: _retrieve_contexts(client, parent, rag_query, vertex_rag_store, bool(rag_file_ids), cache_key),
+        )
+        if fetched is None:
+            return RagQueryResponse(answers=[], documents=[]), ()
+        contexts = fetched
         cache_hit = False
+        if question_embedding is not None and contexts:
+            _store_semantic_contexts(semantic_scope, question_embedding, contexts)
 
     elapsed = time.time() - start_time
 
     if not contexts:
-        return RagQueryResponse(answers=[RagAnswer(text="No relevant context found.", citations=[])], documents=[]), []
+        return RagQueryResponse(answers=[RagAnswer(text="No relevant context found.", citations=[])], documents=[]), ()
 
-    documents: List[RagDocument] = []
-    sources_seen: set[str] = set()
+    # First context per source becomes its document; the dict keeps first-seen order.
+    first_by_source: Dict[str, RetrievedContext] = {}
     for ctx in contexts:
-        source_uri = getattr(ctx, "source_uri", "") or ""
-        text = getattr(ctx, "text", "") or ""
-        distance = getattr(ctx, "distance", None)
-        page_label = _extract_page_label(ctx)
-        metadata: Dict[str, object] | None = {}
-        if distance is not None:
-            metadata["distance"] = distance
-        if page_label:
-            metadata["pageLabel"] = page_label
-        if not metadata:
-            metadata = None
-        if source_uri not in sources_seen:
-            documents.append(
-                RagDocument(
-                    id=source_uri or None,
-                    uri=source_uri or None,
-                    title=source_uri.split("/")[-1] if source_uri else None,
-                    snippet=text[:400],
-                    metadata=metadata,
-                )
-            )
-            sources_seen.add(source_uri)
+        first_by_source.setdefault(ctx.source_uri, ctx)
+    documents = [_make_document(ctx) for ctx in first_by_source.values()]
 
     _log_retrieval_metrics(
         cache_hit=cache_hit,
@@ -327,6 +569,24 @@ def execute_vertex_search(request: RagQueryRequest) -> Tuple[RagQueryResponse, L
     return RagQueryResponse(answers=answers, documents=documents), contexts
 
 
+def _make_document(ctx: RetrievedContext) -> RagDocument:
+    source_uri = ctx.source_uri
+    metadata: Dict[str, object] | None = {}
+    if ctx.distance is not None:
+        metadata["distance"] = ctx.distance
+    if ctx.page_label:
+        metadata["pageLabel"] = ctx.page_label
+    if not metadata:
+        metadata = None
+    return RagDocument(
+        id=source_uri or None,
+        uri=source_uri or None,
+        title=source_uri.split("/")[-1] if source_uri else None,
+        snippet=ctx.text[:400],
+        metadata=metadata,
+    )
+
+
 def _estimate_token_length(text: str) -> int:
     """Rudimentary token estimate based on whitespace splitting."""
     if not text:
@@ -340,16 +600,13 @@ def _log_retrieval_metrics(
     question: str,
     tender_id: str,
     page_size: int,
-    contexts: List[object],
+    contexts: Sequence[RetrievedContext],
 ) -> None:
-    char_lengths: List[int] = []
-    token_lengths: List[int] = []
-    sources: List[str] = []
-    for ctx in contexts:
-        ctx_text = getattr(ctx, "text", "") or ""
-        char_lengths.append(len(ctx_text))
-        token_lengths.append(_estimate_token_length(ctx_text))
-        sources.append(getattr(ctx, "source_uri", "") or "")
+    # Every figure below exists only for this log line; skip the walk when INFO is filtered out.
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    char_lengths = [len(ctx.text) for ctx in contexts]
+    token_lengths = [_estimate_token_length(ctx.text) for ctx in contexts]
 
     if not char_lengths:
         logger.info(
@@ -362,11 +619,12 @@ def _log_retrieval_metrics(
         return
 
     def _stats(values: List[int]) -> Tuple[int, float, float]:
-        return (
-            len(values),
-            float(statistics.mean(values)),
-            float(statistics.median(values)),
-        )
+        # Plain int sum and one sort; statistics.mean/median go through exact Fraction arithmetic.
+        count = len(values)
+        ordered = sorted(values)
+        mid = count // 2
+        median = ordered[mid] if count % 2 else (ordered[mid - 1] + ordered[mid]) / 2
+        return count, sum(values) / count, float(median)
 
     ctx_count, chars_mean, chars_median = _stats(char_lengths)
     _, tokens_mean, tokens_median = _stats(token_lengths)
@@ -382,7 +640,7 @@ def _log_retrieval_metrics(
         chars_median,
         tokens_mean,
         tokens_median,
-        len(set(sources)),
+        len({ctx.source_uri for ctx in contexts}),
     )
 
 
@@ -407,16 +665,7 @@ def _extract_page_label(ctx: object) -> Optional[str]:
         return value_str or None
 
     def _pull_from_dict(data: Dict[str, object]) -> Optional[str]:
-        for key in (
-            "page",
-            "pageNumber",
-            "page_number",
-            "page_label",
-            "pageLabel",
-            "page_label_text",
-            "pageNumbers",
-            "page_numbers",
-        ):
+        for key in _PAGE_LABEL_KEYS:
             if key in data:
                 return _normalize(data[key])
         return None
@@ -428,10 +677,7 @@ def _extract_page_label(ctx: object) -> Optional[str]:
         )
         if candidate:
             return candidate
-        try:
-            chunk_dict = MessageToDict(chunk_metadata._pb, preserving_proto_field_name=True)  # type: ignore[attr-defined]
-        except Exception:  # pragma: no cover - best effort
-            chunk_dict = {}
+        chunk_dict = _page_label_fields(chunk_metadata)
         if chunk_dict:
             candidate = _pull_from_dict(chunk_dict)
             if candidate:
@@ -444,10 +690,7 @@ def _extract_page_label(ctx: object) -> Optional[str]:
             if candidate:
                 return candidate
         else:
-            try:
-                meta_dict = MessageToDict(metadata._pb, preserving_proto_field_name=True)  # type: ignore[attr-defined]
-            except Exception:  # pragma: no cover - best effort
-                meta_dict = {}
+            meta_dict = _page_label_fields(metadata)
             if meta_dict:
                 candidate = _pull_from_dict(meta_dict)
                 if candidate:
@@ -455,11 +698,51 @@ def _extract_page_label(ctx: object) -> Optional[str]:
     return None
 
 
+def _page_label_fields(message: object) -> Dict[str, object]:
+    """The populated page-label fields of a proto message, shaped like MessageToDict output.
+
+    Reads the set fields directly so the rest of the message is never converted.
+    """
+    try:
+        pb = message._pb  # type: ignore[attr-defined]
+        if pb.DESCRIPTOR.full_name == "google.protobuf.Struct":
+            # Struct keys live in a map, not in fields; MessageToDict flattens them.
+            return MessageToDict(pb, preserving_proto_field_name=True)
+        fields: Dict[str, object] = {}
+        for descriptor, value in pb.ListFields():
+            if descriptor.name not in _PAGE_LABEL_KEYS:
+                continue
+            if descriptor.label == descriptor.LABEL_REPEATED:
+                fields[descriptor.name] = [_proto_value(descriptor, item) for item in value]
+            else:
+                fields[descriptor.name] = _proto_value(descriptor, value)
+        return fields
+    except Exception:  # pragma: no cover - best effort
+        try:
+            return MessageToDict(message._pb, preserving_proto_field_name=True)  # type: ignore[attr-defined]
+        except Exception:
+            return {}
+
+
+def _proto_value(descriptor, value: object) -> object:
+    if descriptor.message_type is not None:
+        return MessageToDict(value, preserving_proto_field_name=True)
+    if descriptor.enum_type is not None:
+        enum_value = descriptor.enum_type.values_by_number.get(value)
+        return enum_value.name if enum_value is not None else value
+    return value
+
+
 def _clean_snippet(snippet: Optional[str]) -> Optional[str]:
     if not snippet:
         return None
-    collapsed = " ".join(snippet.split())
     max_len = 240
+    # Collapsing a prefix yields a prefix of the fully collapsed text, so only look past the
+    # first 2 * max_len characters when they collapse to max_len or fewer.
+    head = snippet[: 2 * max_len]
+    collapsed = " ".join(head.split())
+    if len(collapsed) <= max_len and len(snippet) > len(head):
+        collapsed = " ".join(snippet.split())
     if len(collapsed) > max_len:
         return collapsed[:max_len].rstrip() + "…"
     return collapsed
@@ -474,46 +757,57 @@ def _make_snippet_from_match(text: str, start: int, length: int, padding: int =
 
 def supplement_answer_evidence_from_contexts(
     answers: List[RagAnswer],
-    contexts: List[object],
+    contexts: Sequence[RetrievedContext],
     *,
     max_matches: int = 3,
 ) -> None:
     if not answers or not contexts:
         return
+    ctx_index = [ctx for ctx in contexts if ctx.text and ctx.source_uri]
+    if not ctx_index:
+        return
+    # Fragments never contain a newline, so one newline-joined haystack lets each fragment be
+    # located across every context with a single scan instead of one find() per context.
+    haystack = "\n".join(ctx.text_lower for ctx in ctx_index)
+    ctx_starts: List[int] = []
+    offset = 0
+    for ctx in ctx_index:
+        ctx_starts.append(offset)
+        offset += len(ctx.text_lower) + 1
     for answer in answers:
         if answer.evidence:
             continue
         raw_text = (answer.text or "").strip()
         if not raw_text:
             continue
-        lowered = raw_text.lower()
-        if lowered.startswith("no ") or lowered.startswith("not "):
+        # Only the leading words decide a negative answer; don't lowercase the whole text for it.
+        if raw_text[:4].lower().startswith(("no ", "not ")):
             continue
         fragments = [segment.strip() for segment in raw_text.replace("\r", "").split("\n") if segment.strip()]
         if not fragments:
             fragments = [raw_text]
+        normalized_fragments = [
+            (fragment, normalized_fragment)
+            for fragment in fragments
+            if len(normalized_fragment := fragment.lower()) >= 4
+        ]
         seen_keys: Set[Tuple[str, Optional[str]]] = set()
         matches = 0
-        for fragment in fragments:
-            normalized_fragment = fragment.lower()
-            if len(normalized_fragment) < 4:
-                continue
-            for ctx in contexts:
-                ctx_text = getattr(ctx, "text", "") or ""
-                if not ctx_text:
-                    continue
-                ctx_lower = ctx_text.lower()
-                idx = ctx_lower.find(normalized_fragment)
-                if idx == -1:
-                    continue
-                source_uri = getattr(ctx, "source_uri", "") or ""
-                if not source_uri:
-                    continue
-                page_label = _extract_page_label(ctx)
+        for fragment, normalized_fragment in normalized_fragments:
+            hit = haystack.find(normalized_fragment)
+            while hit != -1:
+                position = bisect_right(ctx_starts, hit) - 1
+                ctx = ctx_index[position]
+                idx = hit - ctx_starts[position]
+                # Only the first occurrence per context counts; resume at the next context.
+                next_start = position + 1
+                hit = haystack.find(normalized_fragment, ctx_starts[next_start]) if next_start < len(ctx_starts) else -1
+                source_uri = ctx.source_uri
+                page_label = ctx.page_label
                 key = (source_uri, page_label)
                 if key in seen_keys:
                     continue
-                snippet = _make_snippet_from_match(ctx_text, idx, len(fragment))
+                snippet = _make_snippet_from_match(ctx.text, idx, len(fragment))
                 answer.evidence.append(
                     AnswerEvidence(
                         docId=source_uri,
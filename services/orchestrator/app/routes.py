@@ -1,18 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import json
 import logging
-from datetime import datetime, timezone
-from typing import Dict, List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List
 
-from fastapi import FastAPI, HTTPException, Request, status
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, status
+from fastapi.responses import ORJSONResponse
 from google.api_core import exceptions as google_exceptions
 from google.cloud import firestore
 
 from pipeline import DEFAULT_PIPELINE, build_pipeline_run_document
 
-from .clients import get_firestore_client
+from .clients import get_firestore_client, get_rag_data_client, get_rag_service_client, get_storage_client
 from .config import settings
 from .generative import generate_document_answer, has_substantive_answer
 from .models import (
@@ -23,24 +28,65 @@ from .models import (
     RagQueryResponse,
     RagAnswer,
 )
-from .pipeline_runner import execute_pipeline
+from .pipeline_runner import create_http_client, execute_pipeline
 from .playbook import run_playbook, filter_structured_entries, format_structured_entries
 from .rag import (
     delete_rag_files,
     execute_vertex_search,
-    map_rag_files_by_uri,
+    map_rag_uris_by_name,
     populate_answer_evidence,
     supplement_answer_evidence_from_contexts,
 )
 
 logger = logging.getLogger(__name__)
 
+# Pub/Sub push is at-least-once; remember recent message IDs to drop redeliveries cheaply.
+_SEEN_MESSAGE_LIMIT = 10_000
+_seen_message_ids: "OrderedDict[str, None]" = OrderedDict()
+# Matches Pub/Sub's default message retention; processedEvents entries older than this are dead weight.
+_PROCESSED_EVENT_RETENTION = timedelta(days=7)
+
+
+def _remember_message(message_id: str) -> None:
+    _seen_message_ids[message_id] = None
+    _seen_message_ids.move_to_end(message_id)
+    while len(_seen_message_ids) > _SEEN_MESSAGE_LIMIT:
+        _seen_message_ids.popitem(last=False)
+
+
+def _warm_clients() -> None:
+    # Pay client construction and channel setup once at boot instead of on the first request.
+    for factory in (get_firestore_client, get_storage_client, get_rag_data_client, get_rag_service_client):
+        try:
+            factory()
+        except Exception as exc:  # pragma: no cover - env misconfig
+            logger.warning("Client warm-up failed for %s; it will be created on first use: %s", factory.__name__, exc)
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Vertex RAG, Gemini and GCS clients are synchronous and run via asyncio.to_thread. The
+    # default pool (min(32, cpus + 4) threads) caps in-flight calls far below what a playbook
+    # fans out on a small Cloud Run instance; the threads mostly sit waiting on the network.
+    executor = ThreadPoolExecutor(max_workers=settings.blocking_io_workers, thread_name_prefix="blocking-io")
+    asyncio.get_running_loop().set_default_executor(executor)
+    try:
+        await asyncio.to_thread(_warm_clients)
+        # Task service calls from pipeline runs share one connection pool for the app's lifetime.
+        async with create_http_client() as http_client:
+            app.state.http_client = http_client
+            yield
+    finally:
+        executor.shutdown(wait=False)
+
 
 def create_app() -> FastAPI:
     app = FastAPI(
         title="Tender Pipeline Orchestrator",
         description="Coordinates managed Vertex RAG playbook execution.",
         version="0.1.0",
+        default_response_class=ORJSONResponse,
+        lifespan=_lifespan,
     )
 
     @app.get("/healthz", tags=["meta"])
@@ -54,8 +100,18 @@ def create_app() -> FastAPI:
                 status_code=503,
                 detail="Vertex RAG corpus is not configured. Set VERTEX_RAG_CORPUS_PATH.",
             )
+        gcs_uris: List[str] = list(request.gcsUris or [])
+        # Retrieval and the direct document pass are independent Vertex calls; start retrieval
+        # now and run the document pass alongside it once its URIs are known.
+        search = asyncio.ensure_future(asyncio.to_thread(execute_vertex_search, request))
         try:
-            payload, contexts = execute_vertex_search(request)
+            if not gcs_uris and request.ragFileIds:
+                uris_by_name = await asyncio.to_thread(map_rag_uris_by_name, request.ragFileIds)
+                gcs_uris.extend(uri for name in request.ragFileIds for uri in uris_by_name.get(name, ()))
+            (payload, contexts), (structured_entries, raw_text) = await asyncio.gather(
+                search,
+                asyncio.to_thread(generate_document_answer, request.question, gcs_uris, mode="freeform"),
+            )
         except google_exceptions.ResourceExhausted as exc:
             logger.warning("RAG query quota exhausted for tender %s: %s", request.tenderId, exc)
             raise HTTPException(
@@ -68,16 +124,11 @@ def create_app() -> FastAPI:
         except Exception as exc:  # pragma: no cover - defensive
             logger.exception("RAG query failed for tender %s.", request.tenderId)
             raise HTTPException(status_code=502, detail=f"Vertex Agent Builder query failed: {exc}") from exc
+        finally:
+            # A failed URI lookup leaves retrieval unawaited; drop it rather than leak its result.
+            if not search.done():
+                search.cancel()
 
-        gcs_uris: List[str] = list(request.gcsUris or [])
-        if not gcs_uris and request.ragFileIds:
-            mapping = map_rag_files_by_uri()
-            wanted = set(request.ragFileIds)
-            for uri, name in mapping.items():
-                if name in wanted:
-                    gcs_uris.append(uri)
-
-        structured_entries, raw_text = generate_document_answer(request.question, gcs_uris, mode="freeform")
         filtered_entries = filter_structured_entries("ad_hoc", structured_entries)
 
         if filtered_entries:
@@ -111,7 +162,7 @@ def create_app() -> FastAPI:
                 detail="Provide either gcsUris to import or ragFileIds to reuse existing RagFiles.",
             )
         try:
-            response = run_playbook(request)
+            response = await run_playbook(request)
         except google_exceptions.ResourceExhausted as exc:
             logger.warning("Playbook quota exhausted for tender %s: %s", request.tenderId, exc)
             raise HTTPException(
@@ -132,15 +183,18 @@ def create_app() -> FastAPI:
     async def rag_files_delete(request: RagDeleteRequest) -> Dict[str, List[str]]:
         if not request.ragFileIds:
             raise HTTPException(status_code=400, detail="ragFileIds must not be empty.")
-        deleted, errors = delete_rag_files(request.ragFileIds)
+        deleted, errors = await asyncio.to_thread(delete_rag_files, request.ragFileIds)
         return {"deleted": deleted, "errors": errors}
 
     @app.post("/pubsub/pipeline-trigger", status_code=status.HTTP_202_ACCEPTED)
-    async def handle_pubsub(request: Request) -> Dict[str, str]:
+    async def handle_pubsub(request: Request, background_tasks: BackgroundTasks) -> Dict[str, str]:
         payload = await request.json()
         message = payload.get("message")
         if not message or "data" not in message:
             raise HTTPException(status_code=400, detail="Invalid Pub/Sub message payload.")
+        message_id = message.get("messageId") or message.get("message_id")
+        if message_id and message_id in _seen_message_ids:
+            return {"status": "duplicate", "messageId": message_id}
         try:
             data_bytes = base64.b64decode(message["data"])
             trigger_payload = json.loads(data_bytes)
@@ -161,8 +215,13 @@ def create_app() -> FastAPI:
         )
         firestore_client = get_firestore_client()
         pipeline_doc = firestore_client.collection(settings.pipeline_collection).document(tender_id)
+        run_ref = pipeline_doc.collection("runs").document(run_id)
+        tender_ref = firestore_client.collection(settings.tenders_collection).document(tender_id)
         now = datetime.now(timezone.utc).isoformat()
-        pipeline_doc.set(
+        # One commit for the pipeline rollup, run document and tender rollup.
+        batch = firestore_client.batch()
+        batch.set(
+            pipeline_doc,
             {
                 "tenderId": tender_id,
                 "latestRunId": run_id,
@@ -170,13 +229,37 @@ def create_app() -> FastAPI:
             },
             merge=True,
         )
-        run_ref = pipeline_doc.collection("runs").document(run_id)
-        run_ref.set(run_document)
-        firestore_client.collection(settings.tenders_collection).document(tender_id).set(
+        batch.set(run_ref, run_document)
+        batch.set(
+            tender_ref,
             {"tenderId": tender_id, "pipelineRunId": run_id, "lastUpdated": now},
             merge=True,
         )
-        await execute_pipeline(firestore_client, run_ref, run_document)
+        if message_id:
+            # create() fails the whole commit if another instance already handled this message.
+            event_ref = firestore_client.collection(settings.processed_events_collection).document(message_id)
+            batch.create(
+                event_ref,
+                {
+                    "tenderId": tender_id,
+                    "runId": run_id,
+                    "processedAt": now,
+                    # A Timestamp, so a Firestore TTL policy on this field can prune the collection.
+                    "expireAt": datetime.now(timezone.utc) + _PROCESSED_EVENT_RETENTION,
+                },
+            )
+        try:
+            await batch.commit()
+        except google_exceptions.AlreadyExists:
+            _remember_message(message_id)
+            logger.info("Ignoring redelivered Pub/Sub message %s for tender %s.", message_id, tender_id)
+            return {"status": "duplicate", "messageId": message_id}
+        if message_id:
+            _remember_message(message_id)
+        # Ack the push once the run is recorded; the pipeline itself runs after the response.
+        background_tasks.add_task(
+            execute_pipeline, firestore_client, run_ref, run_document, getattr(request.app.state, "http_client", None)
+        )
         logger.info("Queued pipeline run %s for tender %s.", run_id, tender_id)
         return {"status": "queued", "tenderId": tender_id, "runId": run_id}
 
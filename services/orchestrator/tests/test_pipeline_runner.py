@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from google.cloud import firestore
+
+from app import pipeline_runner
+from pipeline import PipelineDefinition, Task, build_pipeline_run_document
+
+DEFINITION = PipelineDefinition(
+    tasks=[
+        Task(task_id="extract", stage="sequential", order=0, target="extractor"),
+        Task(task_id="summary", stage="parallel", order=1, target="summarizer"),
+        Task(task_id="dates", stage="parallel", order=1, target="dates"),
+    ]
+)
+
+
+class FakeRunRef:
+    """Stands in for the run's AsyncDocumentReference and records every update."""
+
+    def __init__(self) -> None:
+        self.id = "run-1"
+        self.parent = SimpleNamespace(parent=SimpleNamespace(id="tid-123"))
+        self.updates: list[dict] = []
+
+    async def update(self, data: dict) -> None:
+        self.updates.append(data)
+
+
+class FakeFirestore:
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return self
+
+    async def get(self):
+        return SimpleNamespace(exists=True, to_dict=lambda: {"sections": []})
+
+
+def _run(monkeypatch, handler) -> tuple[FakeRunRef, list[str]]:
+    calls: list[str] = []
+
+    def record(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.host)
+        return handler(request)
+
+    monkeypatch.setattr(pipeline_runner, "DEFAULT_PIPELINE", DEFINITION)
+    monkeypatch.setattr(pipeline_runner, "_service_endpoint", lambda target: f"http://{target}/run")
+    run_ref = FakeRunRef()
+    run_document = build_pipeline_run_document(
+        definition=DEFINITION, run_id="run-1", tender_id="tid-123", trigger="ingest", ingest_job_id="job-abc"
+    )
+
+    async def run() -> None:
+        async with httpx.AsyncClient(transport=httpx.MockTransport(record)) as client:
+            await pipeline_runner.execute_pipeline(FakeFirestore(), run_ref, run_document, client)
+
+    asyncio.run(run())
+    return run_ref, calls
+
+
+def _task_updates(run_ref: FakeRunRef, task_id: str) -> list[dict]:
+    prefix = f"tasks.{task_id}."
+    return [update for update in run_ref.updates if any(key.startswith(prefix) for key in update)]
+
+
+def test_execute_pipeline_advances_through_stages(monkeypatch):
+    run_ref, calls = _run(monkeypatch, lambda request: httpx.Response(200))
+
+    assert calls[0] == "extractor"
+    assert sorted(calls[1:]) == ["dates", "summarizer"]
+    stages = [update["currentStage"] for update in run_ref.updates if "currentStage" in update]
+    assert stages == [1, 2]
+    for task in DEFINITION.tasks:
+        (update,) = _task_updates(run_ref, task.task_id)
+        assert update[f"tasks.{task.task_id}.status"] == "succeeded"
+    assert run_ref.updates[-1]["status"] == "succeeded"
+
+
+@pytest.mark.parametrize("failing_host", ["extractor", "dates"])
+def test_execute_pipeline_fails_after_three_attempts(monkeypatch, failing_host):
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(503 if request.url.host == failing_host else 200)
+
+    run_ref, calls = _run(monkeypatch, handler)
+
+    assert calls.count(failing_host) == 3
+    task_id = next(task.task_id for task in DEFINITION.tasks if task.target == failing_host)
+    updates = _task_updates(run_ref, task_id)
+    # One write per attempt, each bumping the stored retry counter once.
+    assert len(updates) == 3
+    assert [update[f"tasks.{task_id}.status"] for update in updates] == ["retry", "retry", "failed"]
+    assert all(isinstance(update[f"tasks.{task_id}.retries"], firestore.Increment) for update in updates)
+    assert run_ref.updates[-1]["status"] == "failed"
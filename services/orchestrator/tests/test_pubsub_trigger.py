@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import base64
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from google.api_core import exceptions as google_exceptions
+
+from app import routes
+
+
+class FakeRef:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "FakeRef":
+        return FakeRef(f"{self.path}/{name}")
+
+    def document(self, doc_id: str) -> "FakeRef":
+        return FakeRef(f"{self.path}/{doc_id}")
+
+
+class FakeBatch:
+    def __init__(self, client: "FakeFirestore") -> None:
+        self.client = client
+
+    def set(self, ref, data, merge=False) -> None:
+        pass
+
+    def create(self, ref, data) -> None:
+        self.client.created.append((ref.path, data))
+
+    async def commit(self) -> None:
+        self.client.commits += 1
+        if self.client.commit_error is not None:
+            raise self.client.commit_error
+
+
+class FakeFirestore:
+    def __init__(self, commit_error: Exception | None = None) -> None:
+        self.commit_error = commit_error
+        self.commits = 0
+        self.created: list = []
+
+    def collection(self, name: str) -> FakeRef:
+        return FakeRef(name)
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+
+@pytest.fixture
+def pipeline_runs(monkeypatch):
+    runs: list = []
+
+    async def record(firestore_client, run_ref, run_document, http_client=None) -> None:
+        runs.append(run_ref.path)
+
+    monkeypatch.setattr(routes, "execute_pipeline", record)
+    monkeypatch.setattr(routes, "_seen_message_ids", type(routes._seen_message_ids)())
+    return runs
+
+
+def _push(client: TestClient, message_id: str):
+    data = base64.b64encode(json.dumps({"tenderId": "tid-123", "ingestJobId": "job-abc"}).encode()).decode()
+    return client.post("/pubsub/pipeline-trigger", json={"message": {"data": data, "messageId": message_id}})
+
+
+def test_first_delivery_queues_run_and_records_event(monkeypatch, pipeline_runs):
+    firestore_client = FakeFirestore()
+    monkeypatch.setattr(routes, "get_firestore_client", lambda: firestore_client)
+
+    response = _push(TestClient(routes.create_app()), "m-1")
+
+    assert response.status_code == 202
+    assert response.json()["status"] == "queued"
+    ((path, data),) = firestore_client.created
+    assert path == f"{routes.settings.processed_events_collection}/m-1"
+    assert data["expireAt"].isoformat() > data["processedAt"]
+    assert len(pipeline_runs) == 1
+    assert "m-1" in routes._seen_message_ids
+
+
+def test_seen_message_short_circuits_before_firestore(monkeypatch, pipeline_runs):
+    def no_firestore():
+        raise AssertionError("a remembered message must not reach Firestore")
+
+    monkeypatch.setattr(routes, "get_firestore_client", no_firestore)
+    routes._remember_message("m-1")
+
+    response = _push(TestClient(routes.create_app()), "m-1")
+
+    assert response.json() == {"status": "duplicate", "messageId": "m-1"}
+    assert pipeline_runs == []
+
+
+def test_already_processed_on_commit_is_a_duplicate(monkeypatch, pipeline_runs):
+    firestore_client = FakeFirestore(commit_error=google_exceptions.AlreadyExists("processed"))
+    monkeypatch.setattr(routes, "get_firestore_client", lambda: firestore_client)
+    client = TestClient(routes.create_app())
+
+    response = _push(client, "m-2")
+
+    assert response.status_code == 202
+    assert response.json() == {"status": "duplicate", "messageId": "m-2"}
+    assert pipeline_runs == []
+    # Remembered, so the next redelivery is dropped without another commit.
+    assert _push(client, "m-2").json()["status"] == "duplicate"
+    assert firestore_client.commits == 1
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import dataclasses
+import random
+import threading
+import time
+from typing import List, Optional, Set, Tuple
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from app import rag
+from app.models import AnswerEvidence, RagAnswer
+from app.rag import RetrievedContext
+
+
+@pytest.fixture(autouse=True)
+def reset_retrieval_cache(monkeypatch):
+    monkeypatch.setattr(
+        rag,
+        "settings",
+        dataclasses.replace(rag.settings, vertex_rag_cache_ttl_seconds=300),
+    )
+    for shard in rag._cache_shards:
+        shard.entries.clear()
+        shard.inflight.clear()
+    yield
+    for shard in rag._cache_shards:
+        shard.entries.clear()
+        shard.inflight.clear()
+
+
+def _context(text: str, source_uri: str = "gs://bucket/doc.pdf", page_label: Optional[str] = None) -> RetrievedContext:
+    return RetrievedContext(
+        text=text, text_lower=text.lower(), source_uri=source_uri, distance=None, page_label=page_label
+    )
+
+
+def _keys_in_one_shard(count: int) -> List[Tuple]:
+    shard = rag._cache_shard(("tid", 0))
+    keys = [key for key in (("tid", index) for index in range(10_000)) if rag._cache_shard(key) is shard]
+    return keys[:count]
+
+
+def test_singleflight_runs_one_fetch_for_concurrent_callers():
+    key = ("tid", "question")
+    contexts = (_context("Bid security is 2%."),)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+    results = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return contexts
+
+    def call() -> None:
+        results.append(rag._singleflight_retrieve(key, fetch))
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [contexts] * 5
+    assert not rag._cache_shard(key).inflight
+
+
+def test_singleflight_followers_reraise_leader_error_and_entry_is_cleared():
+    key = ("tid", "question")
+    started, release = threading.Event(), threading.Event()
+    error = RuntimeError("retrieval failed")
+    errors = []
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        raise error
+
+    def call() -> None:
+        try:
+            rag._singleflight_retrieve(key, fetch)
+        except RuntimeError as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(errors) == 4 and all(exc is error for exc in errors)
+    assert not rag._cache_shard(key).inflight
+    # The next caller leads a fresh fetch rather than inheriting the failure.
+    assert rag._singleflight_retrieve(key, lambda: ()) == ()
+
+
+def test_singleflight_follower_wait_is_bounded(monkeypatch):
+    monkeypatch.setattr(rag, "_INFLIGHT_WAIT_SECONDS", 0.05)
+    key = ("tid", "question")
+    started, release = threading.Event(), threading.Event()
+
+    def stalled_fetch():
+        started.set()
+        release.wait(5)
+        return ()
+
+    leader = threading.Thread(target=rag._singleflight_retrieve, args=(key, stalled_fetch))
+    leader.start()
+    assert started.wait(5)
+    try:
+        with pytest.raises(google_exceptions.DeadlineExceeded):
+            rag._singleflight_retrieve(key, stalled_fetch)
+    finally:
+        release.set()
+        leader.join(5)
+
+
+def test_singleflight_leader_rechecks_cache():
+    key = ("tid", "question")
+    contexts = (_context("Cached answer text."),)
+    rag._store_cached_contexts(key, contexts)
+
+    def fetch():
+        raise AssertionError("fetch must not run when the cache is already filled")
+
+    assert rag._singleflight_retrieve(key, fetch) == contexts
+
+
+def test_retrieval_cache_evicts_least_recently_used_per_shard():
+    shard = rag._cache_shard(("tid", 0))
+    keys = _keys_in_one_shard(shard.max_entries + 1)
+    contexts = (_context("Some retrieved text."),)
+    for key in keys[:-1]:
+        rag._store_cached_contexts(key, contexts)
+    assert rag._get_cached_contexts(keys[0]) == contexts
+    rag._store_cached_contexts(keys[-1], contexts)
+
+    assert rag._get_cached_contexts(keys[1]) is None
+    assert rag._get_cached_contexts(keys[0]) == contexts
+    assert rag._get_cached_contexts(keys[-1]) == contexts
+    assert len(shard.entries) == shard.max_entries
+
+
+@pytest.mark.parametrize("max_entries", [0, 1, 5, 16, 64, 100])
+def test_cache_shards_hold_exactly_the_configured_capacity(max_entries):
+    shards = rag._make_cache_shards(max_entries)
+
+    assert sum(shard.max_entries for shard in shards) == max(max_entries, 1)
+    assert len(shards) <= 16
+    assert all(shard.max_entries >= 1 for shard in shards)
+
+
+def test_retrieval_cache_expires_entries(monkeypatch):
+    key = ("tid", "question")
+    rag._store_cached_contexts(key, (_context("Some retrieved text."),))
+    now = time.time()
+    monkeypatch.setattr(rag.time, "time", lambda: now + 301)
+
+    assert rag._get_cached_contexts(key) is None
+    assert key not in rag._cache_shard(key).entries
+
+
+def _reference_supplement(answers: List[RagAnswer], contexts: List[RetrievedContext], max_matches: int = 3) -> None:
+    """The original matcher: one find() per fragment per context."""
+    ctx_index = [ctx for ctx in contexts if ctx.text and ctx.source_uri]
+    if not answers or not ctx_index:
+        return
+    for answer in answers:
+        if answer.evidence:
+            continue
+        raw_text = (answer.text or "").strip()
+        if not raw_text:
+            continue
+        lowered = raw_text.lower()
+        if lowered.startswith("no ") or lowered.startswith("not "):
+            continue
+        fragments = [segment.strip() for segment in raw_text.replace("\r", "").split("\n") if segment.strip()]
+        if not fragments:
+            fragments = [raw_text]
+        seen_keys: Set[Tuple[str, Optional[str]]] = set()
+        matches = 0
+        for fragment in fragments:
+            normalized_fragment = fragment.lower()
+            if len(normalized_fragment) < 4:
+                continue
+            for ctx in ctx_index:
+                idx = ctx.text.lower().find(normalized_fragment)
+                if idx == -1:
+                    continue
+                key = (ctx.source_uri, ctx.page_label)
+                if key in seen_keys:
+                    continue
+                answer.evidence.append(
+                    AnswerEvidence(
+                        docId=ctx.source_uri,
+                        docTitle=ctx.source_uri.split("/")[-1],
+                        docUri=ctx.source_uri,
+                        pageLabel=ctx.page_label,
+                        snippet=rag._make_snippet_from_match(ctx.text, idx, len(fragment)),
+                        distance=None,
+                    )
+                )
+                seen_keys.add(key)
+                matches += 1
+                if matches >= max_matches:
+                    break
+            if matches >= max_matches:
+                break
+
+
+def test_supplement_evidence_matches_per_context_search():
+    rng = random.Random(1234)
+    alphabet = "abAB \n"
+    for _ in range(300):
+        contexts = [
+            _context(
+                "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))),
+                source_uri=rng.choice(["", "gs://b/one.pdf", "gs://b/two.pdf", "gs://b/three.pdf"]),
+                page_label=rng.choice([None, "1", "2"]),
+            )
+            for _ in range(rng.randint(1, 6))
+        ]
+        texts = []
+        for _ in range(rng.randint(1, 4)):
+            source = rng.choice(contexts).text
+            start = rng.randint(0, len(source))
+            lines = [source[start : start + rng.randint(0, 12)]]
+            lines += ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 6))) for _ in range(rng.randint(0, 2))]
+            texts.append(rng.choice(["", "No ", "not "]) + "\n".join(lines))
+        expected = [RagAnswer(text=text) for text in texts]
+        actual = [RagAnswer(text=text) for text in texts]
+        _reference_supplement(expected, contexts)
+        rag.supplement_answer_evidence_from_contexts(actual, contexts)
+
+        assert [answer.evidence for answer in actual] == [answer.evidence for answer in expected]